@@ -4,12 +4,15 @@
 
 {
     'name': 'Stock available to promise',
-    'version': '11.0.1.0.0',
+    'version': '11.0.1.1.0',
     "author": "Numérigraphe, Sodexis, Odoo Community Association (OCA)",
     'category': 'Warehouse',
     'depends': ['stock'],
     'license': 'AGPL-3',
     'data': [
+        'security/stock_available_security.xml',
+        'security/ir.model.access.csv',
+        'data/ir_cron.xml',
         'views/product_template_view.xml',
         'views/product_product_view.xml',
         'views/res_config_settings_views.xml',
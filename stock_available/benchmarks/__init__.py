@@ -0,0 +1,18 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Benchmarks of the quantities available to promise.
+
+They are not part of the test suite: run them from an ``odoo shell`` on a
+disposable database, as they create a lot of products and stock::
+
+    from odoo.addons.stock_available.benchmarks import template_quantities
+    template_quantities.run(env, templates=1000, variants=500)
+
+    from odoo.addons.stock_available.benchmarks import scaling
+    scaling.run(env, sizes=(1000, 10000, 100000), report='/tmp/atp.json')
+"""
+
+from . import common
+from . import data
+from . import scaling
+from . import template_quantities
@@ -0,0 +1,61 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import json
+import logging
+import time
+import tracemalloc
+
+_logger = logging.getLogger(__name__)
+
+
+def measure(env, function, repeat=3):
+    """ Call *function* *repeat* times with an empty ORM cache.
+
+    The timed calls are not traced: the peak memory is measured during one
+    more call, as tracemalloc slows the python code down.
+    :return: dict with the best wall time in seconds, the number of SQL
+        queries of one call and its peak of python memory in bytes
+    """
+    best = None
+    queries = 0
+    for __ in range(repeat):
+        env.invalidate_all()
+        queries_before = env.cr.sql_log_count
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        queries = env.cr.sql_log_count - queries_before
+        if best is None or elapsed < best:
+            best = elapsed
+    env.invalidate_all()
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # Also resets the peak
+        tracemalloc.clear_traces()
+    else:
+        tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    if not tracing:
+        tracemalloc.stop()
+    return {'seconds': best, 'queries': queries, 'peak_memory': peak_memory}
+
+
+def log_report(title, results):
+    """ Log the results of measure, one line per measured function. """
+    _logger.info(title)
+    for name, result in results:
+        _logger.info(
+            "  %-40s %10.3fs %8d queries %10.1f KiB", name,
+            result['seconds'], result['queries'],
+            result.get('peak_memory', 0) / 1024.0)
+
+
+def write_report(output, report):
+    """ Write *report* as JSON to *output*, a path or a text stream. """
+    if isinstance(output, str):
+        with open(output, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    else:
+        json.dump(report, output, indent=2, sort_keys=True)
@@ -0,0 +1,215 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Synthetic catalogs for the benchmarks.
+
+The templates and locations are created by the ORM, but the additional
+variants, the quants, the moves and the bills of materials are inserted in
+SQL: it is the only way to get hundreds of thousands of them in a
+reasonable time. Every random choice is drawn from a seeded generator, so
+that the same arguments always give the same data.
+"""
+
+import random
+
+
+def create_templates(env, count, variants=1, prefix='BENCH'):
+    """ Create *count* storable templates having *variants* variants each.
+
+    :return: product_template recordset
+    """
+    Template = env['product.template']
+    template_ids = []
+    for index in range(count):
+        template_ids.append(Template.create({
+            'name': '%s %d' % (prefix, index),
+            'type': 'product',
+        }).id)
+    if variants > 1:
+        env.cr.execute("""
+            INSERT INTO product_product (
+                product_tmpl_id, active, default_code,
+                create_uid, create_date, write_uid, write_date)
+            SELECT t.id, true, %s || '-' || t.id || '-' || s.n,
+                %s, now() at time zone 'UTC', %s, now() at time zone 'UTC'
+            FROM product_template t, generate_series(2, %s) AS s(n)
+            WHERE t.id IN %s
+        """, (prefix, env.uid, env.uid, variants, tuple(template_ids)))
+        env.invalidate_all()
+    return Template.browse(template_ids)
+
+
+def create_locations(env, count, parent, prefix='BENCH'):
+    """ Create *count* internal locations under *parent*.
+
+    :return: stock_location recordset
+    """
+    Location = env['stock.location']
+    location_ids = []
+    for index in range(count):
+        location_ids.append(Location.create({
+            'name': '%s %d' % (prefix, index),
+            'location_id': parent.id,
+            'usage': 'internal',
+        }).id)
+    return Location.browse(location_ids)
+
+
+def create_quants(env, products, locations, seed=0, max_qty=100,
+                  reserved_ratio=0.0):
+    """ Put a random quantity of each of *products* in one of *locations*.
+
+    :param reserved_ratio: float, the maximum part of each quant reserved
+    """
+    if not products:
+        return
+    rng = random.Random(seed)
+    quantities = [float(rng.randint(1, max_qty)) for __ in products]
+    env.cr.execute("""
+        INSERT INTO stock_quant (
+            product_id, location_id, company_id, quantity, reserved_quantity,
+            in_date, create_uid, create_date, write_uid, write_date)
+        SELECT q.product_id, q.location_id, l.company_id, q.quantity,
+            q.reserved_quantity, now() at time zone 'UTC', %(uid)s,
+            now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+        FROM unnest(%(product_ids)s, %(location_ids)s, %(quantities)s,
+                %(reserved_quantities)s)
+            AS q(product_id, location_id, quantity, reserved_quantity)
+            JOIN stock_location l ON l.id = q.location_id
+    """, {
+        'uid': env.uid,
+        'product_ids': products.ids,
+        'location_ids': [rng.choice(locations.ids) for __ in products],
+        'quantities': quantities,
+        'reserved_quantities': [
+            float(int(quantity * rng.uniform(0, reserved_ratio)))
+            for quantity in quantities],
+    })
+    env.invalidate_all()
+
+
+def create_moves(env, products, locations, partner_location, seed=0,
+                 per_product=2, max_qty=20, horizon=30):
+    """ Create *per_product* confirmed moves of each of *products*, between
+    *partner_location* and one of *locations*, in either direction.
+
+    The moves are expected at a random date within *horizon* days.
+    """
+    if not products or per_product < 1:
+        return
+    rng = random.Random(seed)
+    product_ids = []
+    location_ids = []
+    location_dest_ids = []
+    quantities = []
+    days = []
+    for product_id in products.ids:
+        for __ in range(per_product):
+            location_id = rng.choice(locations.ids)
+            if rng.random() < 0.5:
+                location_ids.append(partner_location.id)
+                location_dest_ids.append(location_id)
+            else:
+                location_ids.append(location_id)
+                location_dest_ids.append(partner_location.id)
+            product_ids.append(product_id)
+            quantities.append(float(rng.randint(1, max_qty)))
+            days.append(rng.randint(0, horizon))
+    env.cr.execute("""
+        INSERT INTO stock_move (
+            name, product_id, product_uom, product_uom_qty, product_qty,
+            location_id, location_dest_id, company_id, state, procure_method,
+            date, date_expected, create_uid, create_date, write_uid,
+            write_date)
+        SELECT 'BENCH', m.product_id, t.uom_id, m.quantity, m.quantity,
+            m.location_id, m.location_dest_id, %(company)s, 'confirmed',
+            'make_to_stock', now() at time zone 'UTC',
+            now() at time zone 'UTC' + m.days * interval '1 day', %(uid)s,
+            now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+        FROM unnest(%(product_ids)s, %(location_ids)s,
+                %(location_dest_ids)s, %(quantities)s, %(days)s)
+            AS m(product_id, location_id, location_dest_id, quantity, days)
+            JOIN product_product p ON p.id = m.product_id
+            JOIN product_template t ON t.id = p.product_tmpl_id
+    """, {
+        'company': env.user.company_id.id,
+        'uid': env.uid,
+        'product_ids': product_ids,
+        'location_ids': location_ids,
+        'location_dest_ids': location_dest_ids,
+        'quantities': quantities,
+        'days': days,
+    })
+    env.invalidate_all()
+
+
+def create_boms(env, products, components, seed=0, lines=3, max_qty=5,
+                phantom_ratio=0.0, line_uoms=None):
+    """ Create a bill of materials for each of *products*, made of *lines*
+    of *components* picked at random.
+
+    Does nothing when the mrp module is not installed.
+    :param phantom_ratio: float, the part of the BoMs created as sets
+    :param line_uoms: product_uom recordset, the UoMs to pick the UoM of
+        the lines from, instead of the UoM of the components; they must be
+        in the same category
+    :return: list of the ids of the bills of materials
+    """
+    if 'mrp.bom' not in env or not products or not components:
+        return []
+    rng = random.Random(seed)
+    product_ids = products.ids
+    env.cr.execute("""
+        INSERT INTO mrp_bom (
+            product_tmpl_id, product_id, product_qty, product_uom_id, type,
+            ready_to_produce, company_id, active, sequence, create_uid,
+            create_date, write_uid, write_date)
+        SELECT p.product_tmpl_id, p.id, 1.0, t.uom_id, b.type, 'asap',
+            %(company)s, true, 1, %(uid)s, now() at time zone 'UTC',
+            %(uid)s, now() at time zone 'UTC'
+        FROM unnest(%(product_ids)s, %(types)s) AS b(product_id, type)
+            JOIN product_product p ON p.id = b.product_id
+            JOIN product_template t ON t.id = p.product_tmpl_id
+        RETURNING id
+    """, {
+        'company': env.user.company_id.id,
+        'uid': env.uid,
+        'product_ids': product_ids,
+        'types': ['phantom' if phantom_ratio and rng.random() < phantom_ratio
+                  else 'normal' for __ in product_ids],
+    })
+    bom_ids = [row[0] for row in env.cr.fetchall()]
+    bom_line_ids = []
+    component_ids = []
+    quantities = []
+    uom_ids = []
+    for bom_id in bom_ids:
+        if lines <= len(components):
+            picked_ids = rng.sample(components.ids, lines)
+        else:
+            picked_ids = [rng.choice(components.ids) for __ in range(lines)]
+        for component_id in picked_ids:
+            bom_line_ids.append(bom_id)
+            component_ids.append(component_id)
+            quantities.append(float(rng.randint(1, max_qty)))
+            uom_ids.append(rng.choice(line_uoms.ids) if line_uoms else None)
+    env.cr.execute("""
+        INSERT INTO mrp_bom_line (
+            bom_id, product_id, product_qty, product_uom_id, sequence,
+            create_uid, create_date, write_uid, write_date)
+        SELECT l.bom_id, l.product_id, l.quantity,
+            COALESCE(l.uom_id, t.uom_id), 1, %(uid)s,
+            now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+        FROM unnest(%(bom_ids)s, %(component_ids)s, %(quantities)s,
+                %(uom_ids)s::integer[])
+            AS l(bom_id, product_id, quantity, uom_id)
+            JOIN product_product p ON p.id = l.product_id
+            JOIN product_template t ON t.id = p.product_tmpl_id
+    """, {
+        'uid': env.uid,
+        'bom_ids': bom_line_ids,
+        'component_ids': component_ids,
+        'quantities': quantities,
+        'uom_ids': uom_ids,
+    })
+    env.invalidate_all()
+    return bom_ids
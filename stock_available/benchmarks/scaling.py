@@ -0,0 +1,112 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Measure how the computations and searches of the available quantities
+scale with the size of the catalog.
+
+The synthetic catalog grows from one size to the next, so the searches,
+which run over the whole database, see about as many products as the
+size measured. The unreserved quantities and the bills of materials are
+only measured when stock_available_unreserved and mrp are installed.
+"""
+
+import platform
+
+from .common import measure, log_report, write_report
+from .data import (create_boms, create_locations, create_moves,
+                   create_quants, create_templates)
+
+
+def _get_measures(env, products):
+    """ Return the functions to measure on *products*.
+
+    :return: list of tuple (name, function)
+    """
+    Product = env['product.product']
+    Template = env['product.template']
+    templates = products.mapped('product_tmpl_id')
+    measures = [
+        ('_compute_available_quantities_dict',
+         products._compute_available_quantities_dict),
+        ('template _compute_available_quantities_dict',
+         templates._compute_available_quantities_dict),
+        ('search immediately_usable_qty',
+         lambda: Product.search([('immediately_usable_qty', '>', 0)])),
+        ('search immediately_usable_qty = 0',
+         lambda: Product.search([('immediately_usable_qty', '=', 0)])),
+        ('template search immediately_usable_qty',
+         lambda: Template.search([('immediately_usable_qty', '>', 0)])),
+    ]
+    if hasattr(Product, '_compute_product_available_not_res_dict'):
+        measures += [
+            ('_compute_product_available_not_res_dict',
+             products._compute_product_available_not_res_dict),
+            ('search qty_available_not_res',
+             lambda: Product.search([('qty_available_not_res', '>', 0)])),
+            ('template search qty_available_not_res',
+             lambda: Template.search([('qty_available_not_res', '>', 0)])),
+        ]
+    return measures
+
+
+def run(env, sizes=(1000, 10000, 100000), variants=10, locations=10,
+        moves=2, bom_ratio=0.1, seed=0, repeat=3, report=None):
+    """ Grow the catalog to each of *sizes* products and time the
+    computations and searches.
+
+    :param variants: int, the number of variants per template
+    :param locations: int, the number of internal locations holding stock
+    :param moves: int, the number of confirmed moves per product
+    :param bom_ratio: float, the part of the products having a bill of
+        materials made of other benchmark products
+    :param seed: int, the seed of the data generator
+    :param report: path or text stream to write the JSON report to
+    :return: dict, the report
+    """
+    stock_location = env.ref('stock.stock_location_stock')
+    partner_location = env.ref('stock.stock_location_customers')
+    bench_locations = create_locations(env, locations, stock_location)
+    products = env['product.product']
+    results_by_size = []
+    for size in sorted(sizes):
+        missing = size - len(products)
+        if missing > 0:
+            size_seed = seed + size
+            templates = create_templates(
+                env, -(-missing // variants), variants=variants,
+                prefix='BENCH%d' % size)
+            new_products = templates.mapped('product_variant_ids')[:missing]
+            create_quants(env, new_products, bench_locations, seed=size_seed,
+                          reserved_ratio=0.5)
+            create_moves(env, new_products, bench_locations,
+                         partner_location, seed=size_seed,
+                         per_product=moves)
+            bom_count = int(len(new_products) * bom_ratio)
+            create_boms(env, new_products[:bom_count],
+                        new_products[bom_count:], seed=size_seed)
+            products |= new_products
+        results = [
+            (name, measure(env, function, repeat))
+            for name, function in _get_measures(env, products)
+        ]
+        log_report("Available quantities of %d products" % len(products),
+                   results)
+        results_by_size.append({
+            'products': len(products),
+            'results': dict(results),
+        })
+    res = {
+        'parameters': {
+            'sizes': sorted(sizes),
+            'variants': variants,
+            'locations': locations,
+            'moves': moves,
+            'bom_ratio': bom_ratio,
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'python': platform.python_version(),
+        'sizes': results_by_size,
+    }
+    if report is not None:
+        write_report(report, res)
+    return res
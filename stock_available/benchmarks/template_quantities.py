@@ -0,0 +1,35 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Compare the grouped aggregation of the templates' quantities available
+to promise with the aggregation of the quantities computed per variant.
+
+The report logs one line per aggregation with its best wall time, the
+number of SQL queries of one call and its peak of python memory. Quote
+these three figures of both lines, with the sizes of the catalog and the
+version of PostgreSQL, when changing either aggregation: the grouped
+aggregation is only worth keeping while it stays ahead on all three.
+"""
+
+from .common import measure, log_report
+from .data import create_quants, create_templates
+
+
+def run(env, templates=1000, variants=500, repeat=3):
+    """ Create the catalog and time both aggregations.
+
+    :return: list of tuple (name, result of measure)
+    """
+    records = create_templates(env, templates, variants=variants)
+    create_quants(env, records.mapped('product_variant_ids'),
+                  env.ref('stock.stock_location_stock'))
+    results = [
+        ('grouped aggregation', measure(
+            env, records._compute_available_quantities_dict, repeat)),
+        ('aggregation of the variants', measure(
+            env, records._compute_available_quantities_dict_by_variant,
+            repeat)),
+    ]
+    log_report(
+        "Quantities available to promise of %d templates x %d variants" % (
+            templates, variants), results)
+    return results
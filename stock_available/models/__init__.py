@@ -5,3 +5,7 @@
 from . import product_product
 from . import product_template
 from . import res_config_settings
+from . import stock_available_atp
+from . import stock_available_change
+from . import stock_move
+from . import stock_quant
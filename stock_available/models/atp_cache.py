@@ -0,0 +1,98 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from collections import OrderedDict, defaultdict
+import threading
+import time
+import weakref
+
+
+class AvailableQuantitiesCache(object):
+    """ Process-level LRU cache of the quantities available to promise.
+
+    Entries are keyed by (dbname, product_id, context key) and expire after
+    *ttl* seconds, which bounds the staleness of the entries of a process
+    when the stock changes in another one. The stock changes made in the
+    current process invalidate the entries of their products at once.
+    """
+
+    def __init__(self, max_size=0, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._keys_by_product = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_size, ttl):
+        with self._lock:
+            self.max_size = max_size
+            self.ttl = ttl
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, key, values):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), dict(values))
+            self._entries.move_to_end(key)
+            self._keys_by_product[key[:2]].add(key)
+            self._evict()
+
+    def invalidate(self, dbname, product_ids):
+        with self._lock:
+            for product_id in product_ids:
+                for key in self._keys_by_product.pop(
+                        (dbname, product_id), ()):
+                    self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_product.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_product.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_product[key[:2]]
+
+    def _evict(self):
+        while len(self._entries) > max(self.max_size, 0):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+
+CACHE = AvailableQuantitiesCache()
+
+# Cursors of the transactions which changed the stock: the quantities they
+# compute are not committed, they are not published in the cache
+DIRTY_CURSORS = weakref.WeakSet()
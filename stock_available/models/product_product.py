@@ -2,10 +2,20 @@
 # Copyright 2016 Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models
+from odoo import _, api, fields, models
 from odoo.addons import decimal_precision as dp
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+from odoo.tools.float_utils import float_round
+from datetime import timedelta
+from functools import partial
+from itertools import accumulate
+import csv
+import json
 import operator as py_operator
 
+from .atp_cache import CACHE, DIRTY_CURSORS
+
 OPERATORS = {
     '<': py_operator.lt,
     '>': py_operator.gt,
@@ -15,6 +25,27 @@ OPERATORS = {
     '!=': py_operator.ne
 }
 
+# Rounds the quantity %(qty)s in SQL like float_round with the rounding
+# %(rounding)s of the unit of measure
+ROUND_QTY_SQL = 'ROUND((%(qty)s)::numeric / %(rounding)s) * %(rounding)s'
+
+MOVE_TODO_STATES = ('waiting', 'confirmed', 'assigned', 'partially_available')
+
+# Lengths of the buckets of the projected quantities available to promise
+BUCKET_INTERVALS = {
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+
+# Columns of the feeds of quantities available to promise
+FEED_FIELDS = ('product_id', 'default_code', 'immediately_usable_qty',
+               'potential_qty')
+
+# Context keys changing the quantities available to promise
+STOCK_CONTEXT_KEYS = ('location', 'warehouse', 'lot_id', 'owner_id',
+                      'package_id', 'from_date', 'to_date', 'force_company',
+                      'company_owned', 'compute_child')
+
 
 class ProductProduct(models.Model):
 
@@ -27,22 +58,479 @@ class ProductProduct(models.Model):
     @api.multi
     def _compute_available_quantities_dict(self):
         res = {}
+        potentials = self._compute_potential_qty_dict()
         for product in self:
             res[product.id] = {
                 'immediately_usable_qty': product.virtual_available,
-                'potential_qty': 0.0
+                'potential_qty': potentials[product.id]
             }
         return res
 
+    @api.multi
+    def _compute_potential_qty_dict(self):
+        """ Compute the quantities of the products that could be made.
+
+        There is no potential unless a module overrides this method.
+        :return: dict {product_id: potential_qty}
+        """
+        return dict.fromkeys(self.ids, 0.0)
+
     @api.multi
     @api.depends('virtual_available')
     def _compute_available_quantities(self):
-        res = self._compute_available_quantities_dict()
+        res = self._get_available_quantities_cached()
         for product in self:
             for key, value in res[product.id].items():
                 if hasattr(product, key):
                     product[key] = value
 
+    @api.multi
+    def _get_available_quantities(self):
+        """ Return the materialized quantities, or compute them. """
+        res = self.env['stock.available.atp']._read_quantities(self)
+        missing = self.filtered(lambda p: p.id not in res)
+        if missing:
+            res.update(missing._compute_available_quantities_dict())
+        return res
+
+    @api.model
+    def _get_available_quantities_cache_key(self):
+        """ Return the part of the cache keys depending on the environment.
+
+        :return: tuple, or None when the cache is disabled
+        """
+        icp = self.env['ir.config_parameter'].sudo()
+        CACHE.configure(
+            int(icp.get_param('stock_available_cache_size', 0)),
+            int(icp.get_param('stock_available_cache_ttl', 60)))
+        if CACHE.max_size <= 0:
+            return None
+        stock_context = []
+        for key in STOCK_CONTEXT_KEYS:
+            value = self.env.context.get(key)
+            if isinstance(value, list):
+                value = tuple(value)
+            stock_context.append(value)
+        return (self.env.uid, self.env.user.company_id.id,
+                tuple(stock_context))
+
+    @api.multi
+    def _get_available_quantities_cached(self):
+        """ Return the quantities, reusing the ones cached by the process.
+
+        The cache is enabled by setting the system parameter
+        stock_available_cache_size to the maximum number of entries. The
+        transactions which changed the stock don't fill it.
+        """
+        cache_key = self._get_available_quantities_cache_key()
+        if cache_key is None or not all(
+                isinstance(product_id, int) for product_id in self.ids):
+            return self._get_available_quantities()
+        dbname = self.env.cr.dbname
+        res = {}
+        for product_id in self.ids:
+            values = CACHE.get((dbname, product_id, cache_key))
+            if values is not None:
+                res[product_id] = values
+        missing = self.filtered(lambda p: p.id not in res)
+        if missing:
+            quantities = missing._get_available_quantities()
+            # The quantities of a transaction which changed the stock may
+            # never be committed
+            if self.env.cr not in DIRTY_CURSORS:
+                for product_id, values in quantities.items():
+                    CACHE.set((dbname, product_id, cache_key), values)
+            res.update(quantities)
+        return res
+
+    @api.model
+    def get_available_quantities_cache_stats(self):
+        """ Return the counters of the cache of the current process.
+
+        :return: dict with the keys size, max_size, ttl, hits, misses and
+            evictions
+        """
+        return CACHE.stats()
+
+    @api.multi
+    def _get_domains_by_warehouse(self):
+        """ Return the domains of the quants and moves counted per warehouse.
+
+        The locations are given by the warehouses, the other stock context
+        keys are honoured like in _compute_quantities_dict.
+        :return: tuple (quant domain, move domain)
+        """
+        ctx = self.env.context
+        domain_quant = [('product_id', 'in', self.ids)]
+        domain_move = [('product_id', 'in', self.ids),
+                       ('state', 'in', MOVE_TODO_STATES)]
+        if ctx.get('force_company'):
+            domain_quant.append(('company_id', '=', ctx['force_company']))
+            domain_move.append(('company_id', '=', ctx['force_company']))
+        if ctx.get('lot_id') is not None:
+            domain_quant.append(('lot_id', '=', ctx['lot_id']))
+        if ctx.get('owner_id') is not None:
+            domain_quant.append(('owner_id', '=', ctx['owner_id']))
+            domain_move.append(('restrict_partner_id', '=', ctx['owner_id']))
+        if ctx.get('package_id') is not None:
+            domain_quant.append(('package_id', '=', ctx['package_id']))
+        if ctx.get('from_date'):
+            domain_move.append(('date', '>=', ctx['from_date']))
+        if ctx.get('to_date'):
+            domain_move.append(('date', '<=', ctx['to_date']))
+        return domain_quant, domain_move
+
+    @api.multi
+    def _compute_quantities_by_warehouse(self, warehouses):
+        """ Compute the stock quantities of the products in each warehouse.
+
+        The quants and the moves are grouped by product and warehouse in one
+        query each, instead of computing the quantities once per warehouse
+        context.
+        :type warehouses: stock_warehouse
+        :return: dict {(product_id, warehouse_id): {field: value}} with the
+            fields qty_available, incoming_qty, outgoing_qty and
+            virtual_available
+        """
+        if not self or not warehouses:
+            return {}
+        ctx = self.env.context
+        if ctx.get('to_date') and ctx['to_date'] < fields.Datetime.now():
+            # Quantities in the past are rebuilt from the done moves
+            res = {}
+            for warehouse in warehouses:
+                quantities = self.with_context(
+                    warehouse=warehouse.id)._compute_quantities_dict(
+                        ctx.get('lot_id'), ctx.get('owner_id'),
+                        ctx.get('package_id'), ctx.get('from_date'),
+                        ctx.get('to_date'))
+                for product_id, values in quantities.items():
+                    res[(product_id, warehouse.id)] = values
+            return res
+        domain_quant, domain_move = self._get_domains_by_warehouse()
+        cr = self.env.cr
+        quant_model = self.env['stock.quant']
+        query = quant_model._where_calc(domain_quant)
+        quant_model._apply_ir_rules(query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        cr.execute("""
+            SELECT "stock_quant".product_id, w.id,
+                SUM("stock_quant".quantity)
+            FROM %s, stock_location l, stock_warehouse w, stock_location vl
+            WHERE %s
+                AND l.id = "stock_quant".location_id
+                AND w.id IN %%s AND vl.id = w.view_location_id
+                AND l.parent_left >= vl.parent_left
+                AND l.parent_left < vl.parent_right
+            GROUP BY "stock_quant".product_id, w.id
+        """ % (from_clause, where_clause or 'TRUE'),
+            params + [tuple(warehouses.ids)])
+        quants_res = {(row[0], row[1]): row[2] for row in cr.fetchall()}
+
+        move_model = self.env['stock.move']
+        query = move_model._where_calc(domain_move)
+        move_model._apply_ir_rules(query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        cr.execute("""
+            SELECT "stock_move".product_id, w.id,
+                SUM(CASE WHEN dl.parent_left >= vl.parent_left
+                    AND dl.parent_left < vl.parent_right
+                    THEN "stock_move".product_qty ELSE 0 END),
+                SUM(CASE WHEN sl.parent_left >= vl.parent_left
+                    AND sl.parent_left < vl.parent_right
+                    THEN "stock_move".product_qty ELSE 0 END)
+            FROM %s, stock_location sl, stock_location dl,
+                stock_warehouse w, stock_location vl
+            WHERE %s
+                AND sl.id = "stock_move".location_id
+                AND dl.id = "stock_move".location_dest_id
+                AND w.id IN %%s AND vl.id = w.view_location_id
+                AND (sl.parent_left >= vl.parent_left
+                    AND sl.parent_left < vl.parent_right)
+                    != (dl.parent_left >= vl.parent_left
+                        AND dl.parent_left < vl.parent_right)
+            GROUP BY "stock_move".product_id, w.id
+        """ % (from_clause, where_clause or 'TRUE'),
+            params + [tuple(warehouses.ids)])
+        moves_res = {(row[0], row[1]): row[2:] for row in cr.fetchall()}
+
+        res = {}
+        for product in self.with_context(prefetch_fields=False):
+            rounding = product.uom_id.rounding
+            for warehouse_id in warehouses.ids:
+                key = (product.id, warehouse_id)
+                qty_available = float_round(
+                    quants_res.get(key, 0.0), precision_rounding=rounding)
+                incoming_qty, outgoing_qty = [
+                    float_round(qty, precision_rounding=rounding)
+                    for qty in moves_res.get(key, (0.0, 0.0))]
+                res[key] = {
+                    'qty_available': qty_available,
+                    'incoming_qty': incoming_qty,
+                    'outgoing_qty': outgoing_qty,
+                    'virtual_available': float_round(
+                        qty_available + incoming_qty - outgoing_qty,
+                        precision_rounding=rounding),
+                }
+        return res
+
+    @api.multi
+    def _compute_available_quantities_by_warehouse(self, warehouses):
+        """ Compute the quantities available to promise in each warehouse.
+
+        This is the counterpart of _compute_available_quantities_dict for
+        several warehouses at once: modules overriding one should override
+        the other.
+        :type warehouses: stock_warehouse
+        :return: dict {(product_id, warehouse_id): {field: value}}
+        """
+        return {
+            key: {
+                'immediately_usable_qty': values['virtual_available'],
+                'potential_qty': 0.0,
+            }
+            for key, values in self._compute_quantities_by_warehouse(
+                warehouses).items()
+        }
+
+    @api.multi
+    def _compute_available_quantities_matrix(self, warehouses):
+        """ Return the quantities available to promise of the products in
+        each warehouse, as a dense matrix.
+
+        Rows are products and columns are warehouses, in the order of the
+        recordsets given. Big catalogs should be processed by chunks of a
+        few thousand products.
+        :type warehouses: stock_warehouse
+        :return: dict with the keys product_ids, warehouse_ids,
+            immediately_usable_qty and potential_qty, the last two being
+            lists of rows
+        """
+        quantities = self._compute_available_quantities_by_warehouse(
+            warehouses)
+        res = {
+            'product_ids': self.ids,
+            'warehouse_ids': warehouses.ids,
+        }
+        for field in ('immediately_usable_qty', 'potential_qty'):
+            res[field] = [
+                [quantities[(product_id, warehouse_id)][field]
+                 for warehouse_id in warehouses.ids]
+                for product_id in self.ids
+            ]
+        return res
+
+    @api.multi
+    def _compute_available_quantities_buckets(self, date_start=None,
+                                              buckets=7, interval='day'):
+        """ Project the quantities available to promise over a horizon.
+
+        The quantity on hand is increased and decreased by the moves still
+        to do on their expected date. The moves are summed up per product
+        and bucket in one query, then accumulated bucket after bucket.
+        Moves expected before *date_start* fall in the first bucket, moves
+        expected after the last one are left out.
+        :param date_start: datetime string, the beginning of the first
+            bucket; now if None
+        :param buckets: int, the number of buckets
+        :param interval: str, the length of the buckets: 'day' or 'week'
+        :return: dict with the keys dates, the list of the ends of the
+            buckets, and quantities, a dict {product_id: list of the
+            quantities available at the end of each bucket}
+        """
+        if interval not in BUCKET_INTERVALS:
+            raise UserError(_('Invalid bucket interval %s') % interval)
+        if not isinstance(buckets, int) or buckets < 1:
+            raise UserError(_('At least one bucket is needed'))
+        start = fields.Datetime.from_string(
+            date_start or fields.Datetime.now())
+        delta = BUCKET_INTERVALS[interval]
+        dates = [fields.Datetime.to_string(start + delta * (index + 1))
+                 for index in range(buckets)]
+        res = {'dates': dates, 'quantities': {}}
+        if not self:
+            return res
+        domain_quant, domain_move_in, domain_move_out = \
+            self._get_available_quantities_domains(
+                [('product_id', 'in', self.ids)])
+        sql, params = self._get_available_quantities_sql_part(
+            'stock.quant', domain_quant, 'quantity')
+        queries = ["SELECT product_id, 0 AS bucket, quantity FROM (%s) q"
+                   % sql]
+        query_params = params
+        for domain_move, sign in ((domain_move_in, 1), (domain_move_out, -1)):
+            sql, params = self._get_available_quantities_sql_part(
+                'stock.move', domain_move, 'product_qty', sign=sign,
+                date_field='date_expected')
+            queries.append("""
+                SELECT product_id,
+                    GREATEST(FLOOR(EXTRACT(EPOCH FROM
+                        date - %%s::timestamp) / %%s), 0)::integer,
+                    quantity
+                FROM (%s) m
+                WHERE date < %%s
+            """ % sql)
+            query_params = query_params + [
+                fields.Datetime.to_string(start), delta.total_seconds()
+            ] + params + [dates[-1]]
+        self.env.cr.execute("""
+            SELECT product_id, bucket, SUM(quantity)
+            FROM (%s) parts
+            GROUP BY product_id, bucket
+        """ % " UNION ALL ".join(queries), query_params)
+        moves_by_product = {}
+        for product_id, bucket, quantity in self.env.cr.fetchall():
+            moves_by_product.setdefault(
+                product_id, [0.0] * buckets)[bucket] += quantity
+        for product in self.with_context(prefetch_fields=False):
+            rounding = product.uom_id.rounding
+            res['quantities'][product.id] = [
+                float_round(quantity, precision_rounding=rounding)
+                for quantity in accumulate(
+                    moves_by_product.get(product.id, [0.0] * buckets))
+            ]
+        return res
+
+    @api.multi
+    def _prepare_available_quantities_feed_row(self, values):
+        """ Return the row of the product in the feeds.
+
+        :param values: dict of the quantities computed for the product
+        :return: dict with the keys of FEED_FIELDS
+        """
+        self.ensure_one()
+        return {
+            'product_id': self.id,
+            'default_code': self.default_code or '',
+            'immediately_usable_qty': values['immediately_usable_qty'],
+            'potential_qty': values['potential_qty'],
+        }
+
+    @api.model
+    def _iter_available_quantities_feed(self, domain=None, chunk_size=1000):
+        """ Yield the feed rows of the products matching *domain*.
+
+        The products are read by chunks of *chunk_size*, ordered by id, and
+        the ORM cache is cleared after each chunk so that the memory used
+        doesn't depend on the size of the catalog.
+        :return: generator of dict
+        """
+        domain = list(domain or [])
+        last_id = 0
+        while True:
+            products = self.search(
+                domain + [('id', '>', last_id)], order='id', limit=chunk_size)
+            if not products:
+                break
+            quantities = products._get_available_quantities()
+            for product in products:
+                yield product._prepare_available_quantities_feed_row(
+                    quantities[product.id])
+            last_id = products[-1].id
+            self.invalidate_cache()
+
+    @api.model
+    def _export_available_quantities_feed(self, output, fmt='csv',
+                                          domain=None, chunk_size=1000):
+        """ Write the quantities available to promise of the products
+        matching *domain* to *output*.
+
+        :param output: path of the file to write, or text stream
+        :param fmt: str, csv or jsonl
+        :return: int, the number of rows written
+        """
+        if fmt not in ('csv', 'jsonl'):
+            raise UserError(_('Unsupported feed format %s') % fmt)
+        if isinstance(output, str):
+            with open(output, 'w', encoding='utf-8', newline='') as stream:
+                return self._export_available_quantities_feed(
+                    stream, fmt=fmt, domain=domain, chunk_size=chunk_size)
+        rows = self._iter_available_quantities_feed(
+            domain=domain, chunk_size=chunk_size)
+        count = 0
+        if fmt == 'csv':
+            writer = csv.DictWriter(output, fieldnames=FEED_FIELDS)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                output.write(json.dumps(row) + '\n')
+                count += 1
+        return count
+
+    @api.model
+    def get_available_quantities_cursor(self):
+        """ Return the cursor to pass to get_available_quantities_changes to
+        get the changes happening from now on.
+
+        :return: int
+        """
+        return self.env['stock.available.change'].sudo()._get_cursor()
+
+    @api.model
+    def get_available_quantities_changes(self, cursor, chunk_size=1000):
+        """ Return the quantities available to promise of the products whose
+        stock changed since *cursor*.
+
+        A product may be returned by two successive calls, but no change is
+        missed when always passing the cursor returned by the previous call.
+        :param cursor: int, as returned by get_available_quantities_cursor or
+            by the previous call
+        :return: dict with the new cursor, and the changes as a list of
+            tuple (product_id, immediately_usable_qty, potential_qty)
+        """
+        change_model = self.env['stock.available.change'].sudo()
+        new_cursor = change_model._get_cursor()
+        changes = []
+        for product_ids in split_every(
+                chunk_size, change_model._get_changed_product_ids(cursor)):
+            products = self.with_context(active_test=False).search(
+                [('id', 'in', product_ids)], order='id')
+            quantities = products._get_available_quantities()
+            for product in products:
+                changes.append((
+                    product.id,
+                    quantities[product.id]['immediately_usable_qty'],
+                    quantities[product.id]['potential_qty'],
+                ))
+            self.invalidate_cache()
+        return {'cursor': new_cursor, 'changes': changes}
+
+    @api.multi
+    def _notify_available_quantities_changed(self, locations=None):
+        """ Called when the stock of the products changed.
+
+        Records the change for get_available_quantities_changes, drops the
+        cached quantities of the products, now and when the transaction ends,
+        and refreshes the materialized quantities available to promise, if
+        enabled, once the transaction is committed.
+        :param locations: stock_location recordset where the stock changed,
+            None if unknown
+        """
+        if not self:
+            return
+        self.env['stock.available.change'].sudo()._record(self)
+        cr = self.env.cr
+        invalidate = partial(CACHE.invalidate, cr.dbname, self.ids)
+        invalidate()
+        cr.after('commit', invalidate)
+        cr.after('rollback', invalidate)
+        if cr not in DIRTY_CURSORS:
+            DIRTY_CURSORS.add(cr)
+            cr.after('commit', partial(DIRTY_CURSORS.discard, cr))
+            cr.after('rollback', partial(DIRTY_CURSORS.discard, cr))
+        atp_model = self.env['stock.available.atp'].sudo()
+        if not atp_model._is_enabled():
+            return
+        warehouses = None
+        if locations is not None:
+            warehouses = self.env['stock.warehouse'].sudo().browse()
+            for location in locations.sudo():
+                warehouses |= location.get_warehouse()
+        atp_model._schedule_refresh(self, warehouses)
+
     immediately_usable_qty = fields.Float(
         digits=dp.get_precision('Product Unit of Measure'),
         compute='_compute_available_quantities',
@@ -59,9 +547,286 @@ class ProductProduct(models.Model):
         help="Quantity of this Product that could be produced using "
              "the materials already at hand.")
 
+    @api.model
+    def _get_immediately_usable_qty_order_sql(self, alias):
+        """ Return the SQL expression sorting on immediately_usable_qty.
+
+        Sorting is only possible on the materialized quantities.
+        :return: str, or None if the quantities aren't materialized
+        """
+        atp_model = self.env['stock.available.atp']
+        if not atp_model._is_enabled():
+            return None
+        warehouse_id = atp_model._get_context_warehouse()
+        if warehouse_id is None:
+            return None
+        return """COALESCE((
+            SELECT atp.immediately_usable_qty FROM stock_available_atp atp
+            WHERE atp.product_id = "%s".id
+                AND COALESCE(atp.warehouse_id, 0) = %d), 0)""" % (
+            alias, warehouse_id or 0)
+
+    @api.model
+    def _generate_order_by_inner(self, alias, order_spec, query,
+                                 reverse_direction=False, seen=None):
+        if 'immediately_usable_qty' not in order_spec:
+            return super()._generate_order_by_inner(
+                alias, order_spec, query, reverse_direction=reverse_direction,
+                seen=seen)
+        self._check_qorder(order_spec)
+        order_by_elements = []
+        for order_part in order_spec.split(','):
+            order_split = order_part.split()
+            order_field = order_split[0]
+            order_sql = None
+            if order_field == 'immediately_usable_qty':
+                order_sql = self._get_immediately_usable_qty_order_sql(alias)
+            if order_sql is None:
+                order_by_elements += super()._generate_order_by_inner(
+                    alias, order_part, query,
+                    reverse_direction=reverse_direction, seen=seen)
+                continue
+            order_direction = (order_split[1].upper()
+                               if len(order_split) == 2 else '')
+            if len(order_split) > 2 or order_direction not in (
+                    '', 'ASC', 'DESC'):
+                raise UserError(
+                    _('Invalid "order" specified. A valid "order" '
+                      'specification is a comma-separated list of valid '
+                      'field names (optionally followed by asc/desc for '
+                      'the direction)'))
+            if reverse_direction:
+                order_direction = (
+                    'ASC' if order_direction == 'DESC' else 'DESC')
+            order_by_elements.append(
+                '%s %s' % (order_sql, order_direction))
+        return order_by_elements
+
+    @api.model
+    def fields_get(self, allfields=None, attributes=None):
+        res = super().fields_get(allfields=allfields, attributes=attributes)
+        if 'immediately_usable_qty' in res and self.env[
+                'stock.available.atp']._is_enabled():
+            res['immediately_usable_qty']['sortable'] = True
+        return res
+
+    @api.model
+    def read_group(self, domain, fields, groupby, offset=0, limit=None,
+                   orderby=False, lazy=True):
+        """ Sum up the materialized immediately_usable_qty in the groups.
+
+        The sums of all the groups are read in one query grouped like
+        read_group's, then formatted by read_group's own helpers to be
+        matched with the groups on their values.
+        """
+        res = super().read_group(
+            domain, fields, groupby, offset=offset, limit=limit,
+            orderby=orderby, lazy=lazy)
+        if 'immediately_usable_qty' not in fields or not res:
+            return res
+        atp_model = self.env['stock.available.atp']
+        if not atp_model._is_enabled():
+            return res
+        warehouse_id = atp_model._get_context_warehouse()
+        if warehouse_id is None:
+            return res
+        groupby = [groupby] if isinstance(groupby, str) else list(groupby)
+        if lazy:
+            groupby = groupby[:1]
+        query = self._where_calc(domain)
+        self._apply_ir_rules(query, 'read')
+        annotated_groupbys = [
+            self._read_group_process_groupby(gb, query) for gb in groupby]
+        groupby_dict = {gb['groupby']: gb for gb in annotated_groupbys}
+        from_clause, where_clause, params = query.get_sql()
+        self.env.cr.execute("""
+            SELECT %s SUM(atp.immediately_usable_qty) AS atp_qty
+            FROM %s, stock_available_atp atp
+            WHERE %s
+                AND atp.product_id = "product_product".id
+                AND COALESCE(atp.warehouse_id, 0) = %%s
+            %s
+        """ % (''.join('%s AS "%s", ' % (gb['qualified_field'],
+                                         gb['groupby'])
+                       for gb in annotated_groupbys),
+               from_clause, where_clause or 'TRUE',
+               'GROUP BY %s' % ', '.join(
+                   str(position) for position in range(
+                       1, len(annotated_groupbys) + 1))
+               if annotated_groupbys else ''),
+            params + [warehouse_id or 0])
+        sums = {}
+        for row in self.env.cr.dictfetchall():
+            qty = row.pop('atp_qty')
+            data = {
+                key: self._read_group_prepare_data(key, value, groupby_dict)
+                for key, value in row.items()
+            }
+            data['id'] = None
+            group = self._read_group_format_result(
+                data, annotated_groupbys, groupby, domain)
+            sums[self._get_atp_group_key(annotated_groupbys, group)] = qty
+        for group in res:
+            key = self._get_atp_group_key(annotated_groupbys, group)
+            group['immediately_usable_qty'] = sums.get(key) or 0.0
+        return res
+
+    @api.model
+    def _get_atp_group_key(self, annotated_groupbys, group):
+        """ Return the values of the grouped fields of a group formatted by
+        read_group, the many2one as ids.
+        """
+        key = []
+        for gb in annotated_groupbys:
+            value = group[gb['groupby']]
+            if gb['type'] == 'many2one' and isinstance(value, (list, tuple)):
+                value = value[0]
+            key.append(value if value is not None else False)
+        return tuple(key)
+
+    @api.model
+    def _get_available_quantities_sql_part(self, model_name, domain, field,
+                                           sign=1, date_field=None):
+        """ Return a query selecting (product_id, quantity) on *model_name*.
+
+        The records are filtered by *domain* with the access rules applied,
+        like read_group does in _compute_quantities_dict.
+        :param model_name: str
+        :param domain: list of tuple (domain)
+        :param field: str, name of the column holding the quantity
+        :param sign: int, -1 to subtract the quantity
+        :param date_field: str, name of a column to select as a third
+            column "date"
+        :return: tuple (query, params)
+        """
+        model = self.env[model_name]
+        query = model._where_calc(domain)
+        model._apply_ir_rules(query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        sql = 'SELECT "%s".product_id, %s"%s"."%s" AS quantity' % (
+            model._table, '-' if sign < 0 else '', model._table, field)
+        if date_field:
+            sql += ', "%s"."%s" AS date' % (model._table, date_field)
+        sql += ' FROM %s' % from_clause
+        if where_clause:
+            sql += ' WHERE %s' % where_clause
+        return sql, params
+
+    @api.model
+    def _get_available_quantities_domains(self, domain=None):
+        """ Return the domains of the quants and moves counted in the
+        quantity available to promise, honouring the stock context keys.
+
+        :param domain: list of tuple (domain) restricting the quants and
+            moves, for instance on their product_id
+        :return: tuple (quant domain, incoming move domain, outgoing move
+            domain)
+        """
+        ctx = self.env.context
+        to_date = ctx.get('to_date')
+        domain_quant_loc, domain_move_in_loc, domain_move_out_loc = \
+            self._get_domain_locations()
+        domain = list(domain or [])
+        domain_quant = domain + list(domain_quant_loc)
+        domain_move_in = domain + [('state', 'in', MOVE_TODO_STATES)] + list(
+            domain_move_in_loc)
+        domain_move_out = domain + [('state', 'in', MOVE_TODO_STATES)] + list(
+            domain_move_out_loc)
+        if ctx.get('lot_id') is not None:
+            domain_quant.append(('lot_id', '=', ctx['lot_id']))
+        if ctx.get('owner_id') is not None:
+            domain_quant.append(('owner_id', '=', ctx['owner_id']))
+            domain_move_in.append(
+                ('restrict_partner_id', '=', ctx['owner_id']))
+            domain_move_out.append(
+                ('restrict_partner_id', '=', ctx['owner_id']))
+        if ctx.get('package_id') is not None:
+            domain_quant.append(('package_id', '=', ctx['package_id']))
+        if ctx.get('from_date'):
+            domain_move_in.append(('date', '>=', ctx['from_date']))
+            domain_move_out.append(('date', '>=', ctx['from_date']))
+        if to_date:
+            domain_move_in.append(('date', '<=', to_date))
+            domain_move_out.append(('date', '<=', to_date))
+        return domain_quant, domain_move_in, domain_move_out
+
+    @api.model
+    def _get_immediately_usable_qty_sql_parts(self, domain=None):
+        """ Return the queries whose sum is the quantity available to promise.
+
+        Each query selects rows of (product_id, quantity); the
+        immediately_usable_qty of a product is the sum of the quantities of
+        all the rows for this product. The base implementation mirrors the
+        virtual_available computation of the stock module, using the same
+        context keys (location, warehouse, lot_id, owner_id, package_id,
+        from_date and to_date).
+
+        Modules overriding _compute_available_quantities_dict should add or
+        replace parts here, or return None when their figure can't be
+        expressed in SQL: the search then falls back to the python filter.
+        :param domain: list of tuple (domain) restricting the quants and
+            moves, for instance on their product_id
+        :return: list of tuple (query, params) or None
+        """
+        to_date = self.env.context.get('to_date')
+        if to_date and to_date < fields.Datetime.now():
+            # Quantities in the past are rebuilt from the done moves
+            return None
+        domain_quant, domain_move_in, domain_move_out = \
+            self._get_available_quantities_domains(domain)
+        return [
+            self._get_available_quantities_sql_part(
+                'stock.quant', domain_quant, 'quantity'),
+            self._get_available_quantities_sql_part(
+                'stock.move', domain_move_in, 'product_qty'),
+            self._get_available_quantities_sql_part(
+                'stock.move', domain_move_out, 'product_qty', sign=-1),
+        ]
+
     @api.model
     def _search_immediately_usable_qty(self, operator, value):
         """ Search function for the immediately_usable_qty field.
+        The quantities are summed up per product in SQL, using the parts
+        given by _get_immediately_usable_qty_sql_parts, so that only the
+        matching ids are returned. The sums are rounded to the unit of
+        measure of the products like the field.
+        Products without any stock nor move are available for 0: when 0
+        matches the condition, the search excludes the products whose
+        quantity doesn't match instead.
+        :param operator: str
+        :param value: str
+        :return: list of tuple (domain)
+        """
+        if operator not in OPERATORS:
+            raise UserError(_('Invalid domain operator %s') % operator)
+        if not isinstance(value, (float, int)):
+            raise UserError(_('Invalid domain right operand %s') % value)
+        parts = self._get_immediately_usable_qty_sql_parts()
+        if parts is None:
+            return self._search_immediately_usable_qty_python(
+                operator, value)
+        zero_matches = OPERATORS[operator](0.0, value)
+        query = """
+            SELECT atp.product_id
+            FROM (%s) AS atp
+            JOIN product_product pp ON pp.id = atp.product_id
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            JOIN product_uom uom ON uom.id = pt.uom_id
+            GROUP BY atp.product_id, uom.rounding
+            HAVING %s(%s %s %%s)
+        """ % (' UNION ALL '.join(part[0] for part in parts),
+               'NOT ' if zero_matches else '',
+               ROUND_QTY_SQL % {'qty': 'SUM(atp.quantity)',
+                                'rounding': 'uom.rounding'},
+               operator)
+        params = [param for part in parts for param in part[1]] + [value]
+        if zero_matches:
+            return [('id', 'not inselect', (query, params))]
+        return [('id', 'inselect', (query, params))]
+
+    @api.model
+    def _search_immediately_usable_qty_python(self, operator, value):
+        """ Filter all the products on their computed quantity.
         The search is quite similar to the Odoo search about quantity available
         (addons/stock/models/product.py,253; _search_product_quantity function)
         :param operator: str
@@ -2,10 +2,14 @@
 # Copyright 2016 Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import models, fields, api
+from odoo import _, models, fields, api
 from odoo.addons import decimal_precision as dp
+from odoo.exceptions import UserError
+from odoo.tools.float_utils import float_round
 import operator as py_operator
 
+from .product_product import ROUND_QTY_SQL
+
 OPERATORS = {
     '<': py_operator.lt,
     '>': py_operator.gt,
@@ -31,6 +35,48 @@ class ProductTemplate(models.Model):
 
     @api.multi
     def _compute_available_quantities_dict(self):
+        """ Sum up the quantities available to promise of the variants.
+
+        The quantities are grouped by template in SQL, using the parts given
+        by the variants' _get_immediately_usable_qty_sql_parts, so that the
+        variants are never computed one by one. The potential is the
+        biggest potential of the active variants, given by their
+        _compute_potential_qty_dict.
+        """
+        parts = None
+        if all(isinstance(template_id, int) for template_id in self.ids):
+            parts = self.env[
+                'product.product']._get_immediately_usable_qty_sql_parts(
+                    [('product_id.product_tmpl_id', 'in', self.ids)])
+        if parts is None:
+            return self._compute_available_quantities_dict_by_variant()
+        query = """
+            SELECT pp.product_tmpl_id, SUM(atp.quantity)
+            FROM (%s) AS atp
+            JOIN product_product pp ON pp.id = atp.product_id
+            WHERE pp.active
+            GROUP BY pp.product_tmpl_id
+        """ % ' UNION ALL '.join(part[0] for part in parts)
+        self.env.cr.execute(
+            query, [param for part in parts for param in part[1]])
+        template_sums = dict(self.env.cr.fetchall())
+        potentials = self.mapped(
+            'product_variant_ids')._compute_potential_qty_dict()
+        res = {}
+        for template in self.with_context(prefetch_fields=False):
+            res[template.id] = {
+                "immediately_usable_qty": float_round(
+                    template_sums.get(template.id, 0.0),
+                    precision_rounding=template.uom_id.rounding),
+                "potential_qty": max(
+                    [potentials[variant.id]
+                     for variant in template.product_variant_ids] or [0.0]),
+            }
+        return res
+
+    @api.multi
+    def _compute_available_quantities_dict_by_variant(self):
+        """ Aggregate the quantities computed for each variant. """
         variants_dict = self.mapped(
             'product_variant_ids')._compute_available_quantities_dict()
         res = {}
@@ -68,6 +114,46 @@ class ProductTemplate(models.Model):
     @api.model
     def _search_immediately_usable_qty(self, operator, value):
         """ Search function for the immediately_usable_qty field.
+        The quantities of the active variants are summed up per template in
+        SQL, using the parts given by the variants'
+        _get_immediately_usable_qty_sql_parts, and rounded to the unit of
+        measure of the templates like the field.
+        :param operator: str
+        :param value: str
+        :return: list of tuple (domain)
+        """
+        if operator not in OPERATORS:
+            raise UserError(_('Invalid domain operator %s') % operator)
+        if not isinstance(value, (float, int)):
+            raise UserError(_('Invalid domain right operand %s') % value)
+        parts = self.env[
+            'product.product']._get_immediately_usable_qty_sql_parts()
+        if parts is None:
+            return self._search_immediately_usable_qty_python(
+                operator, value)
+        zero_matches = OPERATORS[operator](0.0, value)
+        query = """
+            SELECT pp.product_tmpl_id
+            FROM (%s) AS atp
+            JOIN product_product pp ON pp.id = atp.product_id
+            JOIN product_template pt ON pt.id = pp.product_tmpl_id
+            JOIN product_uom uom ON uom.id = pt.uom_id
+            WHERE pp.active
+            GROUP BY pp.product_tmpl_id, uom.rounding
+            HAVING %s(%s %s %%s)
+        """ % (' UNION ALL '.join(part[0] for part in parts),
+               'NOT ' if zero_matches else '',
+               ROUND_QTY_SQL % {'qty': 'SUM(atp.quantity)',
+                                'rounding': 'uom.rounding'},
+               operator)
+        params = [param for part in parts for param in part[1]] + [value]
+        if zero_matches:
+            return [('id', 'not inselect', (query, params))]
+        return [('id', 'inselect', (query, params))]
+
+    @api.model
+    def _search_immediately_usable_qty_python(self, operator, value):
+        """ Filter all the templates on their computed quantity.
         The search is quite similar to the Odoo search about quantity available
         (addons/stock/models/product.py,253; _search_product_quantity function)
         :param operator: str
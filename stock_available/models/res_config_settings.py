@@ -52,18 +52,63 @@ class ResConfigSettings(models.TransientModel):
              "Only the quantity fields have meaning for computing stock",
     )
 
+    stock_available_mrp_allocation = fields.Selection(
+        [('sequence', 'Sequence of the products'),
+         ('margin', 'Margin'),
+         ('velocity', 'Sales velocity')],
+        string='Allocate the components by',
+        help="Every night, allocate the components at hand to the products "
+             "which compete for them, in this order of priority, and store "
+             "the quantity of each product which can actually be "
+             "manufactured.\n"
+             "If empty, the components are not allocated.",
+    )
+
+    stock_available_materialized_atp = fields.Boolean(
+        string='Materialize the quantities available to promise',
+        help="Store the quantities available to promise per product and "
+             "warehouse, and keep them up to date when the stock moves. "
+             "Reading them becomes much faster on big catalogs.\n"
+             "Run the scheduled action reconciling the materialized "
+             "quantities to fill them after enabling this option.")
+
     @api.model
     def get_values(self):
         res = super(ResConfigSettings, self).get_values()
-        res.update(stock_available_mrp_based_on=self.env[
-            'ir.config_parameter'].sudo().get_param(
+        icp = self.env['ir.config_parameter'].sudo()
+        res.update(
+            stock_available_mrp_based_on=icp.get_param(
                 'stock_available_mrp_based_on',
-                'qty_available')
+                'qty_available'),
+            stock_available_mrp_allocation=icp.get_param(
+                'stock_available_mrp_allocation', False),
+            stock_available_materialized_atp=bool(icp.get_param(
+                'stock_available_materialized_atp')),
         )
         return res
 
     @api.multi
     def set_values(self):
         super(ResConfigSettings, self).set_values()
-        self.env['ir.config_parameter'].sudo().set_param(
+        icp = self.env['ir.config_parameter'].sudo()
+        icp.set_param(
             'stock_available_mrp_based_on', self.stock_available_mrp_based_on)
+        icp.set_param(
+            'stock_available_mrp_allocation',
+            self.stock_available_mrp_allocation or False)
+        atp_model = self.env['stock.available.atp'].sudo()
+        was_materialized = atp_model._is_enabled()
+        icp.set_param(
+            'stock_available_materialized_atp',
+            self.stock_available_materialized_atp)
+        if was_materialized and not self.stock_available_materialized_atp:
+            # The rows would be stale when enabling the option again
+            atp_model._purge()
+        # The lists only show the quantities when they are materialized
+        group = self.env.ref('stock_available.group_materialized_atp')
+        user_group = self.env.ref('base.group_user')
+        if self.stock_available_materialized_atp:
+            user_group.write({'implied_ids': [(4, group.id)]})
+        elif group in user_group.implied_ids:
+            user_group.write({'implied_ids': [(3, group.id)]})
+            group.write({'users': [(3, user.id) for user in group.users]})
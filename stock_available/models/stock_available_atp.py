@@ -0,0 +1,310 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from functools import partial
+import logging
+import weakref
+
+import psycopg2
+
+import odoo
+from odoo import SUPERUSER_ID, api, fields, models
+from odoo.addons import decimal_precision as dp
+from odoo.tools.float_utils import float_compare
+
+from .atp_cache import CACHE
+
+_logger = logging.getLogger(__name__)
+
+# Context keys the materialized quantities don't account for
+UNSUPPORTED_CONTEXT_KEYS = ('location', 'lot_id', 'owner_id', 'package_id',
+                            'from_date', 'to_date', 'force_company',
+                            'company_owned', 'compute_child')
+
+# Refreshes waiting for the commit of the transactions changing the stock,
+# per cursor: {'product_ids': set, 'warehouse_ids': set, None for all}
+PENDING_REFRESHES = weakref.WeakKeyDictionary()
+
+
+def _refresh_committed(cr, dbname):
+    """ Refresh the quantities changed by the transaction just committed on
+    *cr*, in a transaction of its own. """
+    pending = PENDING_REFRESHES.pop(cr, None)
+    if not pending or not pending['product_ids']:
+        return
+    try:
+        with api.Environment.manage(), \
+                odoo.registry(dbname).cursor() as new_cr:
+            env = api.Environment(new_cr, SUPERUSER_ID, {})
+            env['stock.available.atp']._refresh_pending_values(pending)
+    except psycopg2.Error:
+        _logger.warning(
+            "The materialized quantities available to promise of %d "
+            "products could not be refreshed, they are left to the "
+            "reconciliation", len(pending['product_ids']), exc_info=True)
+
+
+class StockAvailableAtp(models.Model):
+    """ Materialized quantities available to promise.
+
+    One row is kept per product and warehouse, plus one row without
+    warehouse holding the figures over all the warehouses. The rows are
+    refreshed once the transactions changing the moves and quants of the
+    product are committed, and reconciled by a scheduled action.
+    Refreshing the rows in a transaction of its own keeps the transactions
+    moving the same products from conflicting on them; until then, the
+    transaction computes the quantities of the products it changed.
+    """
+    _name = 'stock.available.atp'
+    _description = 'Materialized quantities available to promise'
+    _order = 'product_id, warehouse_id'
+
+    product_id = fields.Many2one(
+        comodel_name='product.product',
+        string='Product',
+        required=True,
+        index=True,
+        ondelete='cascade',
+        readonly=True)
+    warehouse_id = fields.Many2one(
+        comodel_name='stock.warehouse',
+        string='Warehouse',
+        index=True,
+        ondelete='cascade',
+        readonly=True,
+        help="Leave empty for the quantities over all the warehouses.")
+    immediately_usable_qty = fields.Float(
+        digits=dp.get_precision('Product Unit of Measure'),
+        string='Available to promise',
+        readonly=True)
+    potential_qty = fields.Float(
+        digits=dp.get_precision('Product Unit of Measure'),
+        string='Potential',
+        readonly=True)
+
+    @api.model_cr
+    def init(self):
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS
+                stock_available_atp_product_warehouse_uniq
+            ON stock_available_atp (product_id, COALESCE(warehouse_id, 0))
+        """)
+
+    @api.model
+    def _is_enabled(self):
+        return bool(self.env['ir.config_parameter'].sudo().get_param(
+            'stock_available_materialized_atp'))
+
+    @api.model
+    def _get_context_warehouse(self):
+        """ Return the row key matching the context of the caller.
+
+        :return: warehouse id, False for the row over all the warehouses,
+            or None when the context can't be served by the materialized
+            quantities.
+        """
+        ctx = self.env.context
+        if ctx.get('stock_available_live') or any(
+                ctx.get(key) for key in UNSUPPORTED_CONTEXT_KEYS):
+            return None
+        warehouse = ctx.get('warehouse')
+        if warehouse:
+            return warehouse if isinstance(warehouse, int) else None
+        # The row over all the warehouses is only valid for users seeing
+        # all of them
+        Warehouse = self.env['stock.warehouse']
+        if Warehouse.search_count([]) != Warehouse.sudo().search_count([]):
+            return None
+        return False
+
+    @api.model
+    def _read_quantities(self, products):
+        """ Return the materialized quantities of *products*.
+
+        Products without a materialized row are left out of the result.
+        :type products: product_product
+        :return: dict {product_id: {field: value}}
+        """
+        pending_ids = self._get_pending_product_ids()
+        product_ids = [pid for pid in products.ids
+                       if isinstance(pid, int) and pid not in pending_ids]
+        if not product_ids or not self._is_enabled():
+            return {}
+        warehouse_id = self._get_context_warehouse()
+        if warehouse_id is None:
+            return {}
+        self.env.cr.execute("""
+            SELECT product_id, immediately_usable_qty, potential_qty
+            FROM stock_available_atp
+            WHERE product_id IN %s AND COALESCE(warehouse_id, 0) = %s
+        """, (tuple(product_ids), warehouse_id or 0))
+        return {
+            product_id: {
+                'immediately_usable_qty': immediately_usable_qty,
+                'potential_qty': potential_qty,
+            }
+            for product_id, immediately_usable_qty, potential_qty
+            in self.env.cr.fetchall()
+        }
+
+    @api.model
+    def _compute_rows(self, products, warehouses):
+        """ Compute the quantities of *products* for each warehouse.
+
+        :return: dict {(product_id, warehouse_id): (immediately_usable_qty,
+            potential_qty)}, warehouse_id being False for the row over all
+            the warehouses.
+        """
+        products = products.sudo().with_context(stock_available_live=True)
+        quantities = products._compute_available_quantities_by_warehouse(
+            warehouses.sudo())
+        for product_id, values in products.with_context(
+                warehouse=False)._compute_available_quantities_dict().items():
+            quantities[(product_id, False)] = values
+        return {
+            key: (values['immediately_usable_qty'], values['potential_qty'])
+            for key, values in quantities.items()
+        }
+
+    @api.model
+    def _refresh(self, products, warehouses=None):
+        """ Recompute and store the quantities of *products*.
+
+        :param warehouses: stock_warehouse recordset, all the warehouses if
+            None. The row over all the warehouses is always refreshed.
+        :return: int, the number of rows created or updated
+        """
+        products = products.filtered(
+            lambda p: p.type in ('product', 'consu'))
+        if not products:
+            return 0
+        if warehouses is None:
+            warehouses = self.env['stock.warehouse'].sudo().search([])
+        cr = self.env.cr
+        cr.execute("""
+            SELECT product_id, COALESCE(warehouse_id, 0),
+                immediately_usable_qty, potential_qty
+            FROM stock_available_atp
+            WHERE product_id IN %s AND COALESCE(warehouse_id, 0) IN %s
+        """, (tuple(products.ids), tuple([0] + warehouses.ids)))
+        stored = {(row[0], row[1] or False): row[2:] for row in cr.fetchall()}
+        digits = self.env['decimal.precision'].precision_get(
+            'Product Unit of Measure')
+        changed = 0
+        changed_product_ids = set()
+        for key, values in self._compute_rows(products, warehouses).items():
+            old_values = stored.get(key)
+            if old_values and all(
+                    not float_compare(old, new, precision_digits=digits)
+                    for old, new in zip(old_values, values)):
+                continue
+            cr.execute("""
+                INSERT INTO stock_available_atp (
+                    product_id, warehouse_id, immediately_usable_qty,
+                    potential_qty, create_uid, create_date, write_uid,
+                    write_date)
+                VALUES (%s, %s, %s, %s, %s, now() at time zone 'UTC', %s,
+                    now() at time zone 'UTC')
+                ON CONFLICT (product_id, COALESCE(warehouse_id, 0))
+                DO UPDATE SET
+                    immediately_usable_qty = EXCLUDED.immediately_usable_qty,
+                    potential_qty = EXCLUDED.potential_qty,
+                    write_uid = EXCLUDED.write_uid,
+                    write_date = EXCLUDED.write_date
+            """, (key[0], key[1] or None) + values + (
+                self.env.uid, self.env.uid))
+            changed += 1
+            changed_product_ids.add(key[0])
+        if changed:
+            self.invalidate_cache()
+            CACHE.invalidate(cr.dbname, changed_product_ids)
+        return changed
+
+    @api.model
+    def _schedule_refresh(self, products, warehouses=None):
+        """ Refresh the quantities of *products* once the transaction is
+        committed.
+
+        :param warehouses: stock_warehouse recordset, all the warehouses if
+            None
+        """
+        product_ids = [pid for pid in products.ids if isinstance(pid, int)]
+        if not product_ids:
+            return
+        cr = self.env.cr
+        pending = PENDING_REFRESHES.get(cr)
+        if pending is None:
+            pending = PENDING_REFRESHES[cr] = {
+                'product_ids': set(),
+                'warehouse_ids': set(),
+            }
+            cr.after('commit', partial(_refresh_committed, cr, cr.dbname))
+            cr.after('rollback', partial(PENDING_REFRESHES.pop, cr, None))
+        pending['product_ids'].update(product_ids)
+        if warehouses is None or pending['warehouse_ids'] is None:
+            pending['warehouse_ids'] = None
+        else:
+            pending['warehouse_ids'].update(warehouses.ids)
+
+    @api.model
+    def _get_pending_product_ids(self):
+        """ Return the ids of the products changed by the transaction,
+        whose rows are not refreshed yet. """
+        pending = PENDING_REFRESHES.get(self.env.cr)
+        return pending['product_ids'] if pending else set()
+
+    @api.model
+    def _refresh_pending(self):
+        """ Refresh now the rows waiting for the commit of the transaction.
+
+        :return: int, the number of rows created or updated
+        """
+        pending = PENDING_REFRESHES.pop(self.env.cr, None)
+        if not pending:
+            return 0
+        return self._refresh_pending_values(pending)
+
+    @api.model
+    def _refresh_pending_values(self, pending):
+        warehouses = None
+        if pending['warehouse_ids'] is not None:
+            warehouses = self.env['stock.warehouse'].sudo().browse(
+                sorted(pending['warehouse_ids'])).exists()
+        products = self.env['product.product'].sudo().browse(
+            sorted(pending['product_ids'])).exists()
+        return self._refresh(products, warehouses)
+
+    @api.model
+    def _purge(self):
+        """ Delete all the rows, which are not kept up to date anymore. """
+        self.env.cr.execute("DELETE FROM stock_available_atp")
+        self.invalidate_cache()
+        CACHE.clear()
+
+    @api.model
+    def _cron_reconcile(self, chunk_size=1000):
+        """ Recompute the materialized quantities of all the products.
+
+        Fixes the rows that drifted from the actual quantities and creates
+        the missing ones.
+        :return: int, the number of rows corrected
+        """
+        if not self._is_enabled():
+            return 0
+        Product = self.env['product.product'].sudo()
+        warehouses = self.env['stock.warehouse'].sudo().search([])
+        corrected = 0
+        last_id = 0
+        while True:
+            products = Product.search(
+                [('id', '>', last_id), ('type', 'in', ('product', 'consu'))],
+                order='id', limit=chunk_size)
+            if not products:
+                break
+            corrected += self._refresh(products, warehouses)
+            last_id = products[-1].id
+            products.invalidate_cache()
+        _logger.info(
+            "Reconciled the materialized quantities available to promise: "
+            "%d rows corrected", corrected)
+        return corrected
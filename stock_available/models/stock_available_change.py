@@ -0,0 +1,100 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, fields, models
+
+
+class StockAvailableChange(models.Model):
+    """ Products whose quantities available to promise changed.
+
+    Each transaction changing the quantities of a product appends one row
+    holding its id, without ever updating the rows of the other
+    transactions, so that concurrent changes of the same product don't
+    conflict. A scheduled action compacts the log to the last row of each
+    product.
+    Cursors are the oldest transaction still running when they are taken:
+    every change committed after a cursor was taken is found again by
+    searching the transactions from this cursor, at the cost of returning a
+    few products twice.
+    """
+    _name = 'stock.available.change'
+    _description = 'Changes of the quantities available to promise'
+    _auto = False
+    _log_access = False
+
+    product_id = fields.Many2one(
+        comodel_name='product.product',
+        string='Product',
+        readonly=True)
+    txid = fields.Integer(
+        string='Transaction',
+        readonly=True)
+
+    @api.model_cr
+    def init(self):
+        cr = self.env.cr
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS stock_available_change (
+                id serial PRIMARY KEY,
+                product_id integer NOT NULL
+                    REFERENCES product_product (id) ON DELETE CASCADE,
+                txid bigint NOT NULL
+            )
+        """)
+        # The table used to hold one row per product
+        cr.execute("""
+            ALTER TABLE stock_available_change
+            DROP CONSTRAINT IF EXISTS stock_available_change_product_id_key
+        """)
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS stock_available_change_txid_index
+            ON stock_available_change (txid)
+        """)
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS stock_available_change_product_index
+            ON stock_available_change (product_id, txid)
+        """)
+
+    @api.model
+    def _record(self, products):
+        """ Record that the quantities of *products* changed, once per
+        transaction. """
+        product_ids = [pid for pid in products.ids if isinstance(pid, int)]
+        if not product_ids:
+            return
+        self.env.cr.execute("""
+            INSERT INTO stock_available_change (product_id, txid)
+            SELECT n.product_id, txid_current()
+            FROM unnest(%s) AS n(product_id)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM stock_available_change c
+                WHERE c.product_id = n.product_id
+                    AND c.txid = txid_current())
+        """, (sorted(set(product_ids)),))
+
+    @api.model
+    def _cron_compact(self):
+        """ Delete the rows of the products changed again later. """
+        self.env.cr.execute("""
+            DELETE FROM stock_available_change c
+            USING stock_available_change newer
+            WHERE newer.product_id = c.product_id
+                AND (newer.txid > c.txid
+                     OR newer.txid = c.txid AND newer.id > c.id)
+        """)
+        return self.env.cr.rowcount
+
+    @api.model
+    def _get_cursor(self):
+        self.env.cr.execute(
+            "SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _get_changed_product_ids(self, cursor):
+        """ Return the ids of the products changed since *cursor*. """
+        self.env.cr.execute("""
+            SELECT DISTINCT product_id FROM stock_available_change
+            WHERE txid >= %s ORDER BY product_id
+        """, (cursor,))
+        return [row[0] for row in self.env.cr.fetchall()]
@@ -0,0 +1,52 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+from .product_product import MOVE_TODO_STATES
+
+# Fields of the moves changing the quantities available to promise
+MOVE_QUANTITY_FIELDS = ('product_id', 'product_uom_qty', 'product_qty',
+                        'product_uom', 'location_id', 'location_dest_id',
+                        'date', 'restrict_partner_id')
+
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    @api.multi
+    def _get_available_quantities_changes(self):
+        """ Return the products and locations of the moves counted in the
+        quantities available to promise.
+
+        :return: tuple (product_product, stock_location)
+        """
+        moves = self.filtered(
+            lambda m: m.state in MOVE_TODO_STATES or m.state == 'done')
+        return (moves.mapped('product_id'),
+                moves.mapped('location_id') | moves.mapped(
+                    'location_dest_id'))
+
+    @api.model
+    def create(self, vals):
+        move = super().create(vals)
+        products, locations = move._get_available_quantities_changes()
+        products._notify_available_quantities_changed(locations)
+        return move
+
+    @api.multi
+    def write(self, vals):
+        if not any(key in vals for key in MOVE_QUANTITY_FIELDS) and (
+                'state' not in vals or (
+                    vals['state'] in MOVE_TODO_STATES and
+                    all(m.state in MOVE_TODO_STATES for m in self))):
+            return super().write(vals)
+        # Moves leaving the quantities are only known before the write,
+        # moves entering them only after it
+        products, locations = self._get_available_quantities_changes()
+        res = super().write(vals)
+        new_products, new_locations = self._get_available_quantities_changes()
+        products |= new_products
+        products._notify_available_quantities_changed(
+            locations | new_locations)
+        return res
@@ -0,0 +1,36 @@
+# Copyright 2018 Numérigraphe
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+
+class StockQuant(models.Model):
+    _inherit = 'stock.quant'
+
+    @api.model
+    def create(self, vals):
+        quant = super().create(vals)
+        quant.product_id._notify_available_quantities_changed(
+            quant.location_id)
+        return quant
+
+    @api.multi
+    def write(self, vals):
+        if not any(key in vals for key in
+                   ('product_id', 'location_id', 'quantity')):
+            return super().write(vals)
+        products = self.mapped('product_id')
+        locations = self.mapped('location_id')
+        res = super().write(vals)
+        products |= self.mapped('product_id')
+        locations |= self.mapped('location_id')
+        products._notify_available_quantities_changed(locations)
+        return res
+
+    @api.multi
+    def unlink(self):
+        products = self.mapped('product_id')
+        locations = self.mapped('location_id')
+        res = super().unlink()
+        products._notify_available_quantities_changed(locations)
+        return res
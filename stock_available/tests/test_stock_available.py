@@ -2,8 +2,17 @@
 # Copyright 2016 Sodexis
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+import csv
+from datetime import timedelta
+import io
+import json
+
+from odoo import fields
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
 
+from ..models.atp_cache import DIRTY_CURSORS
+
 
 class TestStockLogisticsWarehouse(TransactionCase):
     def test_res_config(self):
@@ -139,3 +148,387 @@ class TestStockLogisticsWarehouse(TransactionCase):
         # Potential Qty is set as 0.0 by default
         self.assertEquals(templateAB.potential_qty, 0.0)
         self.assertEquals(productA.potential_qty, 0.0)
+
+        # The grouped aggregation matches the aggregation of the variants
+        self.assertEqual(
+            templateAB._compute_available_quantities_dict(),
+            templateAB._compute_available_quantities_dict_by_variant())
+
+    def test02_search_immediately_usable_qty(self):
+        """checking that the SQL search of immediately_usable_qty honours
+           the warehouse context and rejects invalid operands"""
+        productObj = self.env['product.product']
+        templateObj = self.env['product.template']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        wh_main = self.env.ref('stock.warehouse0')
+        wh_ch = self.env.ref('stock.stock_warehouse_shop0')
+        product = productObj.create(
+            {'name': 'product C',
+             'type': 'product',
+             })
+        move = self.env['stock.move'].create(
+            {'location_id': supplier_location.id,
+             'location_dest_id': wh_main.lot_stock_id.id,
+             'name': 'MOVE INCOMING -> STOCK ',
+             'product_id': product.id,
+             'product_uom': product.uom_id.id,
+             'product_uom_qty': 4,
+             })
+        move._action_confirm()
+
+        domain = [('id', '=', product.id),
+                  ('immediately_usable_qty', '=', 4)]
+        self.assertEqual(productObj.search(domain), product)
+        self.assertFalse(
+            productObj.with_context(warehouse=wh_ch.id).search(domain))
+        self.assertEqual(
+            productObj.with_context(warehouse=wh_ch.id).search(
+                [('id', '=', product.id),
+                 ('immediately_usable_qty', '<=', 0)]),
+            product)
+        self.assertEqual(
+            templateObj.search(
+                [('id', '=', product.product_tmpl_id.id),
+                 ('immediately_usable_qty', '>', 3)]),
+            product.product_tmpl_id)
+
+        with self.assertRaises(UserError):
+            productObj.search([('immediately_usable_qty', 'like', 4)])
+        with self.assertRaises(UserError):
+            productObj.search([('immediately_usable_qty', '>', 'four')])
+
+    def test03_materialized_quantities(self):
+        """checking that the materialized quantities follow the moves and
+           that the reconciliation fixes the rows that drifted"""
+        atpObj = self.env['stock.available.atp']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        wh_main = self.env.ref('stock.warehouse0')
+        self.env['ir.config_parameter'].set_param(
+            'stock_available_materialized_atp', True)
+        product = self.env['product.product'].create(
+            {'name': 'product D',
+             'type': 'product',
+             })
+        move = self.env['stock.move'].create(
+            {'location_id': supplier_location.id,
+             'location_dest_id': wh_main.lot_stock_id.id,
+             'name': 'MOVE INCOMING -> STOCK ',
+             'product_id': product.id,
+             'product_uom': product.uom_id.id,
+             'product_uom_qty': 5,
+             })
+        self.assertFalse(atpObj.search([('product_id', '=', product.id)]))
+
+        move._action_confirm()
+        # The rows are refreshed once the transaction is committed, the
+        # quantities changed meanwhile are computed
+        self.assertFalse(atpObj.search([('product_id', '=', product.id)]))
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 5)
+        atpObj._refresh_pending()
+        rows = atpObj.search([('product_id', '=', product.id)])
+        self.assertEqual(
+            rows.filtered(lambda r: not r.warehouse_id).immediately_usable_qty,
+            5)
+        self.assertEqual(
+            rows.filtered(
+                lambda r: r.warehouse_id == wh_main).immediately_usable_qty,
+            5)
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 5)
+
+        # Drift the stored figure: it is read as is, then reconciled
+        self.env.cr.execute("""
+            UPDATE stock_available_atp SET immediately_usable_qty = 42
+            WHERE product_id = %s AND warehouse_id IS NULL
+        """, (product.id,))
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 42)
+        self.assertEqual(
+            product.with_context(
+                location=wh_main.lot_stock_id.id).immediately_usable_qty,
+            5)
+        self.assertGreaterEqual(atpObj._cron_reconcile(), 1)
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 5)
+
+        # Disabling the option deletes the rows, which would become stale
+        self.env['res.config.settings'].create(
+            {'stock_available_materialized_atp': False}).set_values()
+        self.assertFalse(atpObj.search([]))
+
+    def test04_available_quantities_matrix(self):
+        """checking that the matrix of quantities per warehouse matches the
+           quantities computed in each warehouse context"""
+        productObj = self.env['product.product']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        customer_location = self.env.ref('stock.stock_location_customers')
+        wh_main = self.env.ref('stock.warehouse0')
+        wh_ch = self.env.ref('stock.stock_warehouse_shop0')
+        productE = productObj.create({'name': 'product E', 'type': 'product'})
+        productF = productObj.create({'name': 'product F', 'type': 'product'})
+        moves = self.env['stock.move']
+        for product, source, destination, qty in [
+                (productE, supplier_location, wh_main.lot_stock_id, 7),
+                (productE, wh_main.lot_stock_id, wh_ch.lot_stock_id, 3),
+                (productF, supplier_location, wh_ch.lot_stock_id, 2),
+                (productF, wh_ch.lot_stock_id, customer_location, 1)]:
+            moves |= self.env['stock.move'].create(
+                {'location_id': source.id,
+                 'location_dest_id': destination.id,
+                 'name': 'MOVE',
+                 'product_id': product.id,
+                 'product_uom': product.uom_id.id,
+                 'product_uom_qty': qty,
+                 })
+        moves[0]._action_done()
+        moves[1:]._action_confirm()
+
+        products = productE | productF
+        warehouses = wh_main | wh_ch
+        matrix = products._compute_available_quantities_matrix(warehouses)
+        self.assertEqual(matrix['product_ids'], products.ids)
+        self.assertEqual(matrix['warehouse_ids'], warehouses.ids)
+        self.assertEqual(matrix['immediately_usable_qty'], [[4, 3], [0, 1]])
+        self.assertEqual(matrix['potential_qty'], [[0, 0], [0, 0]])
+        for i, product in enumerate(products):
+            for j, warehouse in enumerate(warehouses):
+                self.assertEqual(
+                    matrix['immediately_usable_qty'][i][j],
+                    product.with_context(
+                        warehouse=warehouse.id).immediately_usable_qty)
+
+    def test05_available_quantities_cache(self):
+        """checking that the cached quantities are reused until the stock
+           of the product changes"""
+        productObj = self.env['product.product']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        stock_location = self.env.ref('stock.stock_location_stock')
+        self.env['ir.config_parameter'].set_param(
+            'stock_available_cache_size', 100)
+        product = productObj.create({'name': 'product G', 'type': 'product'})
+
+        def create_move(qty):
+            return self.env['stock.move'].create(
+                {'location_id': supplier_location.id,
+                 'location_dest_id': stock_location.id,
+                 'name': 'MOVE INCOMING -> STOCK ',
+                 'product_id': product.id,
+                 'product_uom': product.uom_id.id,
+                 'product_uom_qty': qty,
+                 })
+
+        create_move(2)._action_confirm()
+        # The transaction changed the stock: its quantities aren't cached
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 2)
+        stats = productObj.get_available_quantities_cache_stats()
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 2)
+        new_stats = productObj.get_available_quantities_cache_stats()
+        self.assertEqual(new_stats['hits'], stats['hits'])
+        self.assertEqual(new_stats['size'], stats['size'])
+        # As if the transaction was committed
+        DIRTY_CURSORS.discard(self.env.cr)
+
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 2)
+        stats = productObj.get_available_quantities_cache_stats()
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 2)
+        new_stats = productObj.get_available_quantities_cache_stats()
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+        self.assertEqual(new_stats['misses'], stats['misses'])
+
+        # Another context is another entry
+        product.invalidate_cache()
+        self.assertEqual(
+            product.with_context(
+                warehouse=self.env.ref(
+                    'stock.stock_warehouse_shop0').id).immediately_usable_qty,
+            0)
+
+        # The company of the user is part of the key
+        self.assertEqual(
+            productObj._get_available_quantities_cache_key()[1],
+            self.env.user.company_id.id)
+
+        # Moving the stock drops the cached quantities of the product
+        create_move(3)._action_confirm()
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 5)
+        self.env['ir.config_parameter'].set_param(
+            'stock_available_cache_size', 0)
+
+    def test06_available_quantities_feed(self):
+        """checking that the feed pages through the products and writes
+           every product once, in CSV and JSON lines"""
+        productObj = self.env['product.product']
+        products = productObj.browse()
+        for index in range(5):
+            products |= productObj.create({
+                'name': 'feed product %d' % index,
+                'default_code': 'FEED%d' % index,
+                'type': 'product',
+            })
+        domain = [('id', 'in', products.ids)]
+
+        output = io.StringIO()
+        count = productObj._export_available_quantities_feed(
+            output, domain=domain, chunk_size=2)
+        self.assertEqual(count, 5)
+        rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+        self.assertEqual([int(row['product_id']) for row in rows],
+                         products.ids)
+        self.assertEqual(rows[0]['default_code'], 'FEED0')
+        self.assertEqual(float(rows[0]['immediately_usable_qty']), 0)
+
+        output = io.StringIO()
+        productObj._export_available_quantities_feed(
+            output, fmt='jsonl', domain=domain, chunk_size=3)
+        rows = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([row['product_id'] for row in rows], products.ids)
+
+        with self.assertRaises(UserError):
+            productObj._export_available_quantities_feed(
+                output, fmt='xml', domain=domain)
+
+    def test07_available_quantities_changes(self):
+        """checking that the products whose stock changed since a cursor
+           are returned with their quantities"""
+        productObj = self.env['product.product']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        stock_location = self.env.ref('stock.stock_location_stock')
+        moved = productObj.create({'name': 'product H', 'type': 'product'})
+        unmoved = productObj.create({'name': 'product I', 'type': 'product'})
+        cursor = productObj.get_available_quantities_cursor()
+
+        self.env['stock.move'].create(
+            {'location_id': supplier_location.id,
+             'location_dest_id': stock_location.id,
+             'name': 'MOVE INCOMING -> STOCK ',
+             'product_id': moved.id,
+             'product_uom': moved.uom_id.id,
+             'product_uom_qty': 6,
+             })._action_confirm()
+        res = productObj.get_available_quantities_changes(cursor)
+        changes = {change[0]: change[1:] for change in res['changes']}
+        self.assertEqual(changes[moved.id], (6, 0))
+        self.assertNotIn(unmoved.id, changes)
+        self.assertGreaterEqual(res['cursor'], cursor)
+
+        # Every change of the transaction is logged once, and the log is
+        # compacted to the last change of each product
+        change_model = self.env['stock.available.change']
+        moved._notify_available_quantities_changed()
+        self.env.cr.execute("""
+            SELECT COUNT(*) FROM stock_available_change WHERE product_id = %s
+        """, (moved.id,))
+        self.assertEqual(self.env.cr.fetchone()[0], 1)
+        change_model._cron_compact()
+        self.assertIn(moved.id, change_model._get_changed_product_ids(cursor))
+
+    def test08_sort_and_group_immediately_usable_qty(self):
+        """checking that the products can be sorted and grouped on the
+           materialized immediately_usable_qty"""
+        productObj = self.env['product.product']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        stock_location = self.env.ref('stock.stock_location_stock')
+        group = 'stock_available.group_materialized_atp'
+        self.assertFalse(self.env.user.has_group(group))
+        self.env['res.config.settings'].create(
+            {'stock_available_materialized_atp': True}).set_values()
+        self.assertTrue(self.env.user.has_group(group))
+        products = productObj.browse()
+        for qty in (5, 1, 3):
+            product = productObj.create(
+                {'name': 'sorted product %d' % qty, 'type': 'product'})
+            self.env['stock.move'].create(
+                {'location_id': supplier_location.id,
+                 'location_dest_id': stock_location.id,
+                 'name': 'MOVE INCOMING -> STOCK ',
+                 'product_id': product.id,
+                 'product_uom': product.uom_id.id,
+                 'product_uom_qty': qty,
+                 })._action_confirm()
+            products |= product
+        self.env['stock.available.atp']._refresh_pending()
+        domain = [('id', 'in', products.ids)]
+
+        self.assertTrue(
+            productObj.fields_get(
+                ['immediately_usable_qty'])['immediately_usable_qty'][
+                    'sortable'])
+        self.assertEqual(
+            productObj.search(domain, order='immediately_usable_qty').mapped(
+                'immediately_usable_qty'),
+            [1, 3, 5])
+        self.assertEqual(
+            productObj.search(
+                domain, order='immediately_usable_qty desc, id').mapped(
+                    'immediately_usable_qty'),
+            [5, 3, 1])
+        with self.assertRaises(UserError):
+            productObj.search(
+                domain, order='immediately_usable_qty desc;select 1')
+        with self.assertRaises(UserError):
+            productObj.search(domain, order='immediately_usable_qty down')
+        groups = productObj.read_group(
+            domain, ['type', 'immediately_usable_qty'], ['type'])
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0]['immediately_usable_qty'], 9)
+        groups = productObj.read_group(
+            domain, ['name', 'create_date', 'immediately_usable_qty'],
+            ['name', 'create_date:day'], lazy=False)
+        self.assertEqual(
+            sorted((group['name'], group['immediately_usable_qty'])
+                   for group in groups),
+            [('sorted product 1', 1), ('sorted product 3', 3),
+             ('sorted product 5', 5)])
+
+    def test09_available_quantities_buckets(self):
+        """checking the projection of the quantities available to promise
+           on the expected dates of the moves"""
+        productObj = self.env['product.product']
+        supplier_location = self.env.ref('stock.stock_location_suppliers')
+        stock_location = self.env.ref('stock.stock_location_stock')
+        customer_location = self.env.ref('stock.stock_location_customers')
+        product = productObj.create(
+            {'name': 'projected product', 'type': 'product'})
+        other_product = productObj.create(
+            {'name': 'idle product', 'type': 'product'})
+        start = fields.Datetime.from_string('2018-01-01 00:00:00')
+        for days, qty, location, location_dest in (
+                (-3, 4, supplier_location, stock_location),
+                (2, 10, supplier_location, stock_location),
+                (4, 3, stock_location, customer_location),
+                (30, 100, supplier_location, stock_location)):
+            self.env['stock.move'].create(
+                {'location_id': location.id,
+                 'location_dest_id': location_dest.id,
+                 'name': 'MOVE PROJECTED',
+                 'product_id': product.id,
+                 'product_uom': product.uom_id.id,
+                 'product_uom_qty': qty,
+                 'date_expected': fields.Datetime.to_string(
+                     start + timedelta(days=days, hours=1)),
+                 })._action_confirm()
+        products = product | other_product
+
+        res = products._compute_available_quantities_buckets(
+            fields.Datetime.to_string(start), buckets=5)
+        self.assertEqual(res['dates'][0], '2018-01-02 00:00:00')
+        self.assertEqual(res['dates'][-1], '2018-01-06 00:00:00')
+        self.assertEqual(res['quantities'][product.id], [4, 4, 14, 14, 11])
+        self.assertEqual(res['quantities'][other_product.id], [0] * 5)
+
+        res = products._compute_available_quantities_buckets(
+            fields.Datetime.to_string(start), buckets=5, interval='week')
+        self.assertEqual(res['quantities'][product.id], [11, 11, 11, 11, 111])
+
+        with self.assertRaises(UserError):
+            products._compute_available_quantities_buckets(interval='month')
+        for buckets in (0, -1, '7'):
+            with self.assertRaises(UserError):
+                products._compute_available_quantities_buckets(
+                    buckets=buckets)
@@ -2,7 +2,7 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 {
     'name': 'Consider the production potential is available to promise',
-    'version': '11.0.1.0.0',
+    'version': '11.0.1.1.0',
     "author": "Numérigraphe,"
               "Odoo Community Association (OCA)",
     'category': 'Hidden',
@@ -10,6 +10,11 @@
         'stock_available',
         'mrp'
     ],
+    'data': [
+        'security/ir.model.access.csv',
+        'data/ir_cron.xml',
+        'views/product_product_view.xml',
+    ],
     'demo': [
         'demo/mrp_data.xml',
     ],
@@ -0,0 +1,16 @@
+# Copyright 2018 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Benchmarks of the production potential.
+
+They are not part of the test suite: run them from an ``odoo shell`` on a
+disposable database, as they create a lot of products and BoMs::
+
+    from odoo.addons.stock_available_mrp.benchmarks import allocation
+    allocation.run(env, products=5000, components=200)
+
+    from odoo.addons.stock_available_mrp.benchmarks import deep_bom
+    deep_bom.run(env, depth=10, fan_out=100, report='/tmp/deep_bom.json')
+"""
+
+from . import allocation
+from . import deep_bom
@@ -0,0 +1,53 @@
+# Copyright 2018 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Time the allocation of scarce components to the products competing for
+them, with each priority, and compare it to the independent potentials."""
+
+from odoo.addons.stock_available.benchmarks.common import (
+    measure, log_report, write_report)
+from odoo.addons.stock_available.benchmarks.data import (
+    create_boms, create_quants, create_templates)
+
+
+def run(env, products=5000, components=200, lines=5, seed=0, repeat=3,
+        report=None):
+    """ Create *products* having a BoM of *lines* among *components*, and
+    time the allocated and the independent potentials.
+
+    :param report: path or text stream to write the JSON report to
+    :return: list of tuple (name, result of measure)
+    """
+    stock_location = env.ref('stock.stock_location_stock')
+    component_records = create_templates(
+        env, components, prefix='BENCHCOMP').mapped('product_variant_ids')
+    create_quants(env, component_records, stock_location, seed=seed,
+                  max_qty=1000)
+    product_records = create_templates(
+        env, products, prefix='BENCHPROD').mapped('product_variant_ids')
+    create_boms(env, product_records, component_records, seed=seed,
+                lines=lines)
+    # Flatten the BoMs beforehand: they are stored once and for all
+    product_records._get_bom_needs()
+    results = [
+        ('independent potentials', measure(
+            env, product_records._compute_potential_qty_dict, repeat)),
+    ]
+    for priority in ('sequence', 'margin', 'velocity'):
+        results.append(('allocation by %s' % priority, measure(
+            env, lambda: product_records._compute_allocated_potential_qty_dict(
+                priority), repeat)))
+    log_report(
+        "Allocation of %d components to %d products" % (
+            components, products), results)
+    if report is not None:
+        write_report(report, {
+            'parameters': {
+                'products': products,
+                'components': components,
+                'lines': lines,
+                'seed': seed,
+                'repeat': repeat,
+            },
+            'results': dict(results),
+        })
+    return results
@@ -0,0 +1,99 @@
+# Copyright 2018 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+"""Time the potential quantities of products made of deep trees of BoMs.
+
+Each level of the tree holds *width* products, whose BoMs are made of
+*fan_out* products of the level below; the products of the last level are
+raw materials in stock. Some BoMs are sets, and about half the lines are in
+dozens while the products are in units.
+"""
+
+from odoo.addons.stock_available.benchmarks.common import (
+    measure, log_report, write_report)
+from odoo.addons.stock_available.benchmarks.data import (
+    create_boms, create_quants, create_templates)
+
+MAX_DEPTH = 10
+MAX_FAN_OUT = 1000
+
+
+def create_bom_tree(env, depth, fan_out, width, phantom_ratio=0.2,
+                    mixed_uoms=True, seed=0):
+    """ Create *depth* levels of *width* products having a BoM made of
+    *fan_out* products of the level below, and the raw materials.
+
+    :return: list of the product_product recordsets of each level, from
+        the top down
+    """
+    levels = [
+        create_templates(env, width, prefix='BENCHBOM%d' % level).mapped(
+            'product_variant_ids')
+        for level in range(depth + 1)
+    ]
+    line_uoms = env.ref('product.product_uom_unit')
+    if mixed_uoms:
+        line_uoms |= env.ref('product.product_uom_dozen')
+    for level, products in enumerate(levels[:-1]):
+        # The top level products are sold, they aren't sets
+        create_boms(
+            env, products, levels[level + 1], seed=seed + level,
+            lines=fan_out, phantom_ratio=phantom_ratio if level else 0.0,
+            line_uoms=line_uoms)
+    create_quants(env, levels[-1], env.ref('stock.stock_location_stock'),
+                  seed=seed, max_qty=100000)
+    return levels
+
+
+def run(env, depth=5, fan_out=10, width=100, phantom_ratio=0.2,
+        mixed_uoms=True, seed=0, repeat=3, report=None):
+    """ Create the tree of BoMs and time the potential quantities of its
+    top level products, for each way of counting the components.
+
+    :param report: path or text stream to write the JSON report to
+    :return: list of tuple (name, result of measure)
+    """
+    if not 0 < depth <= MAX_DEPTH or not 0 < fan_out <= MAX_FAN_OUT:
+        raise ValueError("The depth must be within 1 and %d and the fan-out "
+                         "within 1 and %d" % (MAX_DEPTH, MAX_FAN_OUT))
+    levels = create_bom_tree(env, depth, fan_out, width,
+                             phantom_ratio=phantom_ratio,
+                             mixed_uoms=mixed_uoms, seed=seed)
+    products = levels[0]
+    all_products = env['product.product'].browse(
+        [product_id for level in levels for product_id in level.ids])
+    icp = env['ir.config_parameter']
+    based_on = icp.get_param('stock_available_mrp_based_on',
+                             'qty_available')
+    results = []
+    try:
+        for field in ('qty_available', 'immediately_usable_qty'):
+            icp.set_param('stock_available_mrp_based_on', field)
+            env['mrp.bom.flat']._invalidate()
+            results += [
+                ('%s: flatten the BoMs' % field, measure(
+                    env, lambda: all_products._get_bom_needs(), 1)),
+                ('%s: potential_qty' % field, measure(
+                    env, lambda: products.mapped('potential_qty'), repeat)),
+                ('%s: immediately_usable_qty' % field, measure(
+                    env, lambda: products.mapped('immediately_usable_qty'),
+                    repeat)),
+            ]
+    finally:
+        icp.set_param('stock_available_mrp_based_on', based_on)
+    log_report(
+        "Potential of %d products over %d levels of %d lines" % (
+            width, depth, fan_out), results)
+    if report is not None:
+        write_report(report, {
+            'parameters': {
+                'depth': depth,
+                'fan_out': fan_out,
+                'width': width,
+                'phantom_ratio': phantom_ratio,
+                'mixed_uoms': mixed_uoms,
+                'seed': seed,
+                'repeat': repeat,
+            },
+            'results': dict(results),
+        })
+    return results
@@ -1,5 +1,8 @@
 # Copyright 2014 Numérigraphe SARL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from . import mrp_bom
+from . import mrp_bom_flat
 from . import product_product
 from . import product_template
+from . import product_uom
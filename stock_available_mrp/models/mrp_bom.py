@@ -0,0 +1,101 @@
+# Copyright 2018 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models
+
+# The fields choosing which BoM _bom_find returns for a product
+BOM_SELECTION_FIELDS = {
+    'active', 'company_id', 'product_id', 'product_tmpl_id', 'sequence'}
+
+
+class MrpBom(models.Model):
+    _inherit = 'mrp.bom'
+
+    @api.multi
+    def _get_produced_products(self):
+        """ Return the variants produced by the BoMs.
+
+        :rtype: product_product
+        """
+        products = self.env['product.product']
+        for bom in self:
+            products |= (bom.product_id or
+                         bom.product_tmpl_id.product_variant_ids)
+        return products
+
+    @api.multi
+    def _invalidate_flattened(self, vals=None):
+        """ Delete the flattened BoMs depending on the BoMs.
+
+        The BoMs of products also having a set, or whose fields choosing
+        the BoM of a product change, may replace another BoM or be replaced
+        by another one in the BoMs exploded through the sets: everything is
+        deleted then.
+        :param vals: dict of the values written, if any
+        """
+        flat_model = self.env['mrp.bom.flat']
+        if vals and BOM_SELECTION_FIELDS.intersection(vals):
+            flat_model._invalidate()
+            return
+        templates = self.sudo().exists().mapped('product_tmpl_id')
+        if templates and self.sudo().search_count([
+                ('type', '=', 'phantom'),
+                ('product_tmpl_id', 'in', templates.ids)]):
+            flat_model._invalidate()
+            return
+        flat_model._invalidate(self)
+
+    @api.model
+    def create(self, vals):
+        bom = super().create(vals)
+        bom._invalidate_flattened()
+        bom._get_produced_products()._notify_available_quantities_changed()
+        return bom
+
+    @api.multi
+    def write(self, vals):
+        products = self._get_produced_products()
+        # Before and after, in case the BoMs become or cease to be sets
+        self._invalidate_flattened(vals)
+        res = super().write(vals)
+        self._invalidate_flattened(vals)
+        products |= self._get_produced_products()
+        products._notify_available_quantities_changed()
+        return res
+
+    @api.multi
+    def unlink(self):
+        products = self._get_produced_products()
+        self._invalidate_flattened()
+        res = super().unlink()
+        products._notify_available_quantities_changed()
+        return res
+
+
+class MrpBomLine(models.Model):
+    _inherit = 'mrp.bom.line'
+
+    @api.model
+    def create(self, vals):
+        line = super().create(vals)
+        self.env['mrp.bom.flat']._invalidate(line.bom_id)
+        products = line.bom_id._get_produced_products()
+        products._notify_available_quantities_changed()
+        return line
+
+    @api.multi
+    def write(self, vals):
+        boms = self.mapped('bom_id')
+        res = super().write(vals)
+        boms |= self.mapped('bom_id')
+        self.env['mrp.bom.flat']._invalidate(boms)
+        boms._get_produced_products()._notify_available_quantities_changed()
+        return res
+
+    @api.multi
+    def unlink(self):
+        boms = self.mapped('bom_id')
+        res = super().unlink()
+        self.env['mrp.bom.flat']._invalidate(boms)
+        boms._get_produced_products()._notify_available_quantities_changed()
+        return res
@@ -0,0 +1,206 @@
+# Copyright 2018 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from collections import Counter
+import logging
+
+from odoo import api, fields, models
+from odoo.addons import decimal_precision as dp
+
+_logger = logging.getLogger(__name__)
+
+
+class MrpBomFlat(models.Model):
+    """ Flattened Bill of Materials of a product.
+
+    The BoM is exploded once for the product: the needs of the components,
+    through all the levels of sets, are stored as lines. The explosion
+    depends on the product because of the lines restricted to some
+    variants, so the BoMs are flattened per product.
+    The records are deleted when the BoMs change, and created again the
+    next time the needs are read.
+    """
+    _name = 'mrp.bom.flat'
+    _description = 'Flattened Bill of Materials'
+    _log_access = False
+
+    bom_id = fields.Many2one(
+        comodel_name='mrp.bom',
+        string='Bill of Materials',
+        required=True,
+        index=True,
+        ondelete='cascade',
+        readonly=True)
+    product_id = fields.Many2one(
+        comodel_name='product.product',
+        string='Product',
+        required=True,
+        ondelete='cascade',
+        readonly=True)
+    line_ids = fields.One2many(
+        comodel_name='mrp.bom.flat.line',
+        inverse_name='flat_id',
+        string='Components',
+        readonly=True)
+
+    _sql_constraints = [
+        ('bom_product_uniq', 'unique (bom_id, product_id)',
+         'A Bill of Materials is flattened only once per product.'),
+    ]
+
+    @api.model
+    def _get_needs(self, boms_products):
+        """ Return the needs of components of each BoM and product, in the
+        UoM of the components, to make one unit of the BoM.
+
+        The BoMs which were not flattened yet for their product are
+        exploded and stored.
+        :param boms_products: list of tuple (mrp_bom, product_product)
+        :return: dict {(bom_id, product_id): Counter {component_id: qty}}
+        """
+        keys = {(bom.id, product.id) for bom, product in boms_products}
+        if not keys:
+            return {}
+        res = self._read_needs(keys)
+        missing = [(bom, product) for bom, product in boms_products
+                   if (bom.id, product.id) not in res]
+        if missing:
+            for bom, product in missing:
+                self._flatten(bom, product)
+            res.update(self._read_needs(keys.difference(res)))
+        return res
+
+    @api.model
+    def _read_needs(self, keys):
+        """ Read the stored needs of the (bom_id, product_id) *keys*. """
+        cr = self.env.cr
+        cr.execute("""
+            SELECT f.bom_id, f.product_id, l.component_id, l.product_qty
+            FROM mrp_bom_flat f
+                LEFT JOIN mrp_bom_flat_line l
+                    ON l.flat_id = f.id AND l.uom_error IS NOT TRUE
+            WHERE (f.bom_id, f.product_id) IN %s
+        """, (tuple(keys),))
+        res = {}
+        for bom_id, product_id, component_id, qty in cr.fetchall():
+            needs = res.setdefault((bom_id, product_id), Counter())
+            if component_id:
+                needs[component_id] += qty
+        return res
+
+    @api.model
+    def _flatten(self, bom, product):
+        """ Explode *bom* for *product* and store the needs. """
+        cr = self.env.cr
+        cr.execute("""
+            INSERT INTO mrp_bom_flat (bom_id, product_id)
+            VALUES (%s, %s)
+            ON CONFLICT (bom_id, product_id) DO NOTHING
+            RETURNING id
+        """, (bom.id, product.id))
+        row = cr.fetchone()
+        if not row:
+            # Flattened meanwhile by another transaction
+            return
+        uom_obj = self.env['product.uom']
+        needs = Counter()
+        uom_errors = set()
+        for bom_line, line_data in bom.sudo().explode(product, 1.0)[1]:
+            component = bom_line.product_id
+            # The BoM is exploded for 1 unit: the factor converting 1 unit
+            # of the line is the quantity of the component in its UoM
+            factor = uom_obj._get_conversion_factor(
+                bom_line.product_uom_id.id, component.uom_id.id)
+            if factor is None:
+                # This occurs, when we have components
+                # which are in a different cateogry.
+                uom_errors.add((component.id, bom_line.product_uom_id.id))
+                continue
+            needs[component.id] += factor * line_data['qty']
+        if needs or uom_errors:
+            cr.execute("""
+                INSERT INTO mrp_bom_flat_line (
+                    flat_id, component_id, product_qty, product_uom_id,
+                    uom_error)
+                SELECT %s, component_id, product_qty, product_uom_id,
+                    uom_error
+                FROM unnest(%s, %s, %s::integer[], %s)
+                    AS n(component_id, product_qty, product_uom_id,
+                        uom_error)
+            """, (row[0],
+                  list(needs) + [error[0] for error in uom_errors],
+                  list(needs.values()) + [0.0] * len(uom_errors),
+                  [None] * len(needs) + [error[1] for error in uom_errors],
+                  [False] * len(needs) + [True] * len(uom_errors)))
+        if uom_errors:
+            _logger.warning(
+                "The BoM %s of the product %s has components in a Unit of "
+                "Measure of another category: they are left out of its "
+                "potential quantity", bom.id, product.id)
+
+    @api.model
+    def _get_uom_errors(self):
+        """ Return the components left out of the flattened BoMs because
+        their Unit of Measure is in another category than the line's.
+
+        :return: list of tuple (mrp_bom, product_product the BoM is
+            flattened for, product_product component, product_uom of the
+            BoM line)
+        """
+        lines = self.env['mrp.bom.flat.line'].search(
+            [('uom_error', '=', True)])
+        return [(line.flat_id.bom_id, line.flat_id.product_id,
+                 line.component_id, line.product_uom_id) for line in lines]
+
+    @api.model
+    def _invalidate(self, boms=None):
+        """ Delete the flattened BoMs depending on *boms*.
+
+        A set can be part of any BoM: when *boms* hold sets, or when no
+        *boms* are given, everything is deleted.
+        :type boms: mrp_bom
+        """
+        cr = self.env.cr
+        if boms is None or any(
+                bom.type == 'phantom' for bom in boms.sudo().exists()):
+            cr.execute("DELETE FROM mrp_bom_flat")
+        elif boms:
+            cr.execute("DELETE FROM mrp_bom_flat WHERE bom_id IN %s",
+                       (tuple(boms.ids),))
+        self.invalidate_cache()
+        self.env['mrp.bom.flat.line'].invalidate_cache()
+
+
+class MrpBomFlatLine(models.Model):
+    _name = 'mrp.bom.flat.line'
+    _description = 'Component of a flattened Bill of Materials'
+    _log_access = False
+
+    flat_id = fields.Many2one(
+        comodel_name='mrp.bom.flat',
+        string='Flattened BoM',
+        required=True,
+        index=True,
+        ondelete='cascade',
+        readonly=True)
+    component_id = fields.Many2one(
+        comodel_name='product.product',
+        string='Component',
+        required=True,
+        ondelete='cascade',
+        readonly=True)
+    product_qty = fields.Float(
+        digits=dp.get_precision('Product Unit of Measure'),
+        string='Quantity',
+        readonly=True,
+        help="Quantity of the component needed to make one unit of the "
+             "Bill of Materials, in the Unit of Measure of the component.")
+    product_uom_id = fields.Many2one(
+        comodel_name='product.uom',
+        string='Unit of Measure of the BoM line',
+        readonly=True)
+    uom_error = fields.Boolean(
+        string='Incompatible Unit of Measure',
+        readonly=True,
+        help="The Unit of Measure of the BoM line is in another category "
+             "than the component's: the component is left out.")
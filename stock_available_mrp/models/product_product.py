@@ -2,12 +2,45 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
 from collections import Counter
+from datetime import timedelta
+import logging
+import math
 
-from odoo import models, fields, api
+from odoo import _, models, fields, api
 from odoo.addons import decimal_precision as dp
+from odoo.addons.stock_available.models.product_product import (
+    BUCKET_INTERVALS, OPERATORS)
+from odoo.osv import expression
 
 from odoo.exceptions import AccessError, UserError
 
+_logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except (ImportError, IOError) as err:
+    np = None
+    _logger.debug(err)
+
+# Fields computed by _compute_quantities_dict
+STOCK_QUANTITY_FIELDS = ('qty_available', 'incoming_qty', 'outgoing_qty',
+                         'virtual_available')
+
+# The potential only adds up to the quantity summed up in SQL: for each
+# operator, the products having a BoM whose SQL quantity matches this
+# operator may match or not, the others are decided by the SQL search
+UNDECIDED_OPERATORS = {
+    '<': '<',
+    '<=': '<=',
+    '>': '<=',
+    '>=': '<',
+    '=': '<=',
+    '!=': '<=',
+}
+
+# Number of days of deliveries giving the sales velocity of the products
+VELOCITY_DAYS = 90
+
 
 class ProductProduct(models.Model):
     _inherit = 'product.product'
@@ -20,14 +53,26 @@ class ProductProduct(models.Model):
         compute='_get_component_ids',
     )
 
+    allocated_potential_qty = fields.Float(
+        digits=dp.get_precision('Product Unit of Measure'),
+        string='Allocated potential',
+        readonly=True,
+        copy=False,
+        help="Quantity of this product that can be manufactured when the "
+             "components at hand are allocated to the products in order of "
+             "priority, instead of being counted for each product.\n"
+             "Computed every night when a priority is chosen in the "
+             "settings.")
+
     @api.multi
     def _compute_available_quantities_dict(self):
         """Add the potential quantity to the quantity available to promise.
 
         This is the same implementation as for templates."""
         res = {}
+        potentials = self._compute_potential_qty_dict()
         for product in self:
-            potential_qty = self._get_potential_qty(product)
+            potential_qty = potentials[product.id]
             res[product.id] = {
                 'immediately_usable_qty': product.virtual_available +
                 potential_qty,
@@ -35,6 +80,75 @@ class ProductProduct(models.Model):
             }
         return res
 
+    @api.multi
+    def _compute_available_quantities_by_warehouse(self, warehouses):
+        """Add the potential quantity of the products having a BoM in each
+        warehouse."""
+        res = super()._compute_available_quantities_by_warehouse(warehouses)
+        bom_products = self.filtered(lambda p: p.product_tmpl_id.bom_ids)
+        potentials = bom_products._compute_potential_qty_by_warehouse(
+            warehouses)
+        for key, potential_qty in potentials.items():
+            res[key]['immediately_usable_qty'] += potential_qty
+            res[key]['potential_qty'] = potential_qty
+        return res
+
+    @api.model
+    def _get_available_quantities_cache_key(self):
+        """The potential depends on the field the components are counted
+        with."""
+        res = super()._get_available_quantities_cache_key()
+        if res is None:
+            return res
+        return res + (self._get_component_qty_field(),)
+
+    @api.multi
+    def _notify_available_quantities_changed(self, locations=None):
+        """The potential of the products made of these ones changed too."""
+        products = self | self._get_where_used()
+        super(ProductProduct, products)._notify_available_quantities_changed(
+            locations)
+
+    @api.multi
+    def _get_where_used(self):
+        """ Return the products whose potential depends on these products.
+
+        The BoMs are walked up from the products to the products made of
+        them. Beyond the first level, only the sets are walked up, unless
+        the potential of the components counts in their quantity: then all
+        the levels are.
+        :rtype: product_product
+        """
+        product_ids = [pid for pid in self.ids if isinstance(pid, int)]
+        if not product_ids:
+            return self.browse()
+        recursive = self._get_component_qty_field() in (
+            'immediately_usable_qty', 'potential_qty')
+        parents = """
+            SELECT p.id, %(recursive)s OR b.type = 'phantom'
+            FROM mrp_bom_line l
+                JOIN mrp_bom b ON b.id = l.bom_id AND b.active
+                JOIN product_product p
+                    ON p.product_tmpl_id = b.product_tmpl_id
+                    AND (b.product_id IS NULL OR p.id = b.product_id)
+                    AND p.active
+        """
+        self.env.cr.execute("""
+            WITH RECURSIVE where_used (product_id, walk_up) AS (
+                %s
+                WHERE l.product_id = ANY(%%(product_ids)s)
+                UNION
+                %s
+                    JOIN where_used w ON w.product_id = l.product_id
+                WHERE w.walk_up
+            )
+            SELECT DISTINCT product_id FROM where_used ORDER BY product_id
+        """ % (parents, parents), {
+            'product_ids': product_ids,
+            'recursive': recursive,
+        })
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
     @api.multi
     @api.depends('virtual_available',
                  'component_ids.potential_qty',
@@ -42,37 +156,569 @@ class ProductProduct(models.Model):
     def _compute_available_quantities(self):
         super()._compute_available_quantities()
 
+    @api.model
+    def _search_immediately_usable_qty(self, operator, value):
+        """The potential of the products having a BoM can't be expressed in
+        SQL. As it is never negative, the SQL search of stock_available
+        decides for most of them: only the products having a BoM that it
+        can't decide (see UNDECIDED_OPERATORS) are filtered in python."""
+        domain = super()._search_immediately_usable_qty(operator, value)
+        if self._get_immediately_usable_qty_sql_parts() is None:
+            # The python search of stock_available already has the potential
+            return domain
+        undecided_products = self.search(expression.AND([
+            [('product_tmpl_id.bom_ids', '!=', False)],
+            super()._search_immediately_usable_qty(
+                UNDECIDED_OPERATORS[operator], value),
+        ]))
+        if not undecided_products:
+            return domain
+        matching_products = undecided_products.filtered(
+            lambda p: OPERATORS[operator](p.immediately_usable_qty, value))
+        return expression.OR([
+            expression.AND([
+                [('id', 'not in', undecided_products.ids)], domain]),
+            [('id', 'in', matching_products.ids)],
+        ])
+
     def _get_potential_qty(self, product):
         """Compute the potential qty based on the available components."""
-        bom_obj = self.env['mrp.bom']
-        bom = bom_obj._bom_find(product=product)
-        if not bom:
-            return 0.0
+        return product.with_env(self.env)._compute_potential_qty_dict()[
+            product.id]
+
+    @api.multi
+    def _get_potential_graph(self):
+        """ Return the graph of the products made of other products.
 
-        # Need by product (same product can be in many BOM lines/levels)
+        The BoMs of the products are walked down, level after level, as far
+        as the potential of the components counts in their quantity.
+        :return: dict {product_id: None for the products without any usable
+            BoM, or tuple (mrp_bom, Counter {component_id: need})}
+        """
+        recursive = self._get_component_qty_field() in (
+            'immediately_usable_qty', 'potential_qty')
+        graph = {}
+        products = self
+        while products:
+            bom_needs = products._get_bom_needs()
+            component_ids = set()
+            for product in products:
+                graph[product.id] = bom_needs.get(product.id)
+                if graph[product.id]:
+                    component_ids.update(graph[product.id][1])
+            products = self.browse(
+                sorted(component_ids.difference(graph))
+                if recursive else [])
+        return graph
+
+    @api.multi
+    def _get_bom_needs(self):
+        """ Return the BoM of the products and the needs of components of
+        one unit of the BoM, read from the flattened BoMs.
+
+        :return: dict {product_id: tuple (mrp_bom, Counter {component_id:
+            need})}, leaving out the products without any usable BoM
+        """
+        bom_obj = self.env['mrp.bom']
+        boms_products = []
+        for product in self:
+            bom = bom_obj._bom_find(product=product)
+            if bom and isinstance(product.id, int):
+                boms_products.append((bom, product))
         try:
-            component_needs = self._get_components_needs(product, bom)
+            # The flattened BoMs are read in SQL: check the user may read
+            # BoMs
+            self.env['mrp.bom.line'].check_access_rights('read')
+            needs = self.env['mrp.bom.flat']._get_needs(boms_products)
         except AccessError:
             # If user doesn't have access to BOM
             # he can't see potential_qty
-            component_needs = None
-        if not component_needs:
-            # The BoM has no line we can use
-            product.potential_qty = 0.0
+            return {}
+        res = {}
+        for bom, product in boms_products:
+            product_needs = needs.get((bom.id, product.id))
+            if product_needs:
+                res[product.id] = (bom, product_needs)
+        return res
+
+    @api.model
+    def _sort_potential_graph(self, graph):
+        """ Sort the products of *graph* in topological order, the
+        components before the products made of them.
+
+        The cycles of BoMs are broken arbitrarily.
+        :return: list of product ids
+        """
+        order = []
+        visited = set()
+        for root_id in graph:
+            if root_id in visited:
+                continue
+            visited.add(root_id)
+            stack = [(root_id, iter(graph[root_id][1] if graph[root_id]
+                                    else ()))]
+            while stack:
+                product_id, component_ids = stack[-1]
+                for component_id in component_ids:
+                    if component_id in graph and \
+                            component_id not in visited:
+                        visited.add(component_id)
+                        stack.append((component_id, iter(
+                            graph[component_id][1] if graph[component_id]
+                            else ())))
+                        break
+                else:
+                    stack.pop()
+                    order.append(product_id)
+        return order
+
+    @api.multi
+    def _compute_potential_qty_dict(self):
+        """ Compute the potential quantities of the products in one pass.
+
+        The graph of the BoMs is built for all the products at once, then
+        the potentials are computed bottom-up in topological order: the
+        potential of each sub-assembly is computed only once, and the
+        quantities of all the components are read in one batch.
+        :return: dict {product_id: potential_qty}
+        """
+        field = self._get_component_qty_field()
+        graph = self._get_potential_graph()
+        components = self._get_potential_graph_components(graph)
+        return self._compute_potential_qty_levels(
+            self._get_potential_levels(graph),
+            components._get_component_quantities(field))
+
+    @api.multi
+    def _compute_potential_qty_by_warehouse(self, warehouses):
+        """ Compute the potential quantities of the products in each
+        warehouse.
+
+        The graph of the BoMs is built only once. The stock quantities of
+        the components are grouped by warehouse in one pass (see
+        _compute_quantities_by_warehouse).
+        :type warehouses: stock_warehouse
+        :return: dict {(product_id, warehouse_id): potential_qty}
+        """
+        if not self or not warehouses:
+            return {}
+        field = self._get_component_qty_field()
+        graph = self._get_potential_graph()
+        components = self._get_potential_graph_components(graph)
+        levels = self._get_potential_levels(graph)
+        quantities = components._get_component_quantities_by_warehouse(
+            field, warehouses)
+        res = {}
+        for warehouse in warehouses:
+            potentials = self._compute_potential_qty_levels(
+                levels, quantities[warehouse.id])
+            for product_id in self.ids:
+                res[(product_id, warehouse.id)] = potentials.get(
+                    product_id, 0.0)
+        return res
+
+    @api.model
+    def _get_potential_graph_components(self, graph):
+        """ Return all the components of the products of *graph*.
+
+        :rtype: product_product
+        """
+        component_ids = set()
+        for node in graph.values():
+            if node:
+                component_ids.update(node[1])
+        return self.browse(sorted(component_ids))
+
+    @api.model
+    def _get_potential_levels(self, graph):
+        """ Group the products of *graph* by depth.
+
+        The products of a level only need the potentials of the levels
+        below, and are computed together. When the potential of the
+        components doesn't count in their quantity, all the products are
+        on the same level.
+        :return: tuple (ids of all the products, list of the levels from
+            the bottom up, each one a list of tuple (product_id, mrp_bom,
+            dict {component_id: need}))
+        """
+        recursive = self._get_component_qty_field() in (
+            'immediately_usable_qty', 'potential_qty')
+        levels = []
+        depths = {}
+        for product_id in self._sort_potential_graph(graph):
+            node = graph[product_id]
+            needs = node and {component_id: need
+                              for component_id, need in node[1].items()
+                              if need > 0}
+            if not needs:
+                # The BoM has no line we can use
+                depths[product_id] = 0
+                continue
+            depth = 1
+            if recursive:
+                depth += max([depths[component_id] for component_id in needs
+                              if component_id in depths] or [0])
+            depths[product_id] = depth
+            while len(levels) < depth:
+                levels.append([])
+            levels[depth - 1].append((product_id, node[0], needs))
+        return list(depths), levels
+
+    @api.model
+    def _compute_potential_qty_levels(self, levels, quantities):
+        """ Compute the potentials of the products level after level.
+
+        :param levels: tuple, see _get_potential_levels
+        :param quantities: dict {component_id: quantity}, see
+            _get_component_quantities
+        :return: dict {product_id: potential_qty}
+        """
+        recursive = self._get_component_qty_field() in (
+            'immediately_usable_qty', 'potential_qty')
+        product_ids, levels = levels
+        res = dict.fromkeys(product_ids, 0.0)
+        for nodes in levels:
+            if recursive:
+                available = {
+                    component_id: qty + res.get(component_id, 0.0)
+                    for component_id, qty in quantities.items()}
+            else:
+                available = quantities
+            res.update(self._compute_potential_qty_batch(nodes, available))
+        return res
+
+    @api.multi
+    def _get_component_quantities(self, field):
+        """ Return a snapshot of the quantities of the components, shared by
+        all the products of a potential computation.
+
+        The stock quantities are computed in one call for all the
+        components. When the potential of the components counts in their
+        quantity, it is left out: it is added by the caller.
+        :param field: str, see _get_component_qty_field
+        :return: dict {component_id: quantity}
+        """
+        if not self:
+            return {}
+        if field == 'potential_qty':
+            return dict.fromkeys(self.ids, 0.0)
+        if field == 'immediately_usable_qty':
+            # The quantity without the potential
+            field = 'virtual_available'
+        if field not in STOCK_QUANTITY_FIELDS:
+            return {component.id: component[field] for component in self}
+        ctx = self.env.context
+        quantities = self._compute_quantities_dict(
+            ctx.get('lot_id'), ctx.get('owner_id'), ctx.get('package_id'),
+            ctx.get('from_date'), ctx.get('to_date'))
+        return {component_id: values[field]
+                for component_id, values in quantities.items()}
+
+    @api.multi
+    def _get_component_quantities_by_warehouse(self, field, warehouses):
+        """ Return a snapshot of the quantities of the components in each
+        warehouse, like _get_component_quantities does for one context.
 
-        else:
+        :type warehouses: stock_warehouse
+        :return: dict {warehouse_id: {component_id: quantity}}
+        """
+        if field == 'immediately_usable_qty':
+            # The quantity without the potential
+            field = 'virtual_available'
+        if field not in STOCK_QUANTITY_FIELDS:
+            return {
+                warehouse.id: self.with_context(
+                    warehouse=warehouse.id)._get_component_quantities(field)
+                for warehouse in warehouses
+            }
+        res = {warehouse.id: {} for warehouse in warehouses}
+        for (component_id, warehouse_id), values in \
+                self._compute_quantities_by_warehouse(warehouses).items():
+            res[warehouse_id][component_id] = values[field]
+        return res
+
+    @api.model
+    def _compute_potential_qty_batch(self, nodes, quantities):
+        """ Compute the potential quantities of products from the quantities
+        of their components.
+
+        NumPy is used when it is installed: the needs of all the products
+        are laid out in flat arrays, and the ratios and their minimum per
+        product are computed by vectorized operations.
+        :param nodes: list of tuple (product_id, mrp_bom, dict {component_id:
+            need}), the needs being strictly positive
+        :param quantities: dict {component_id: quantity available}
+        :return: dict {product_id: potential_qty}
+        """
+        if not nodes:
+            return {}
+        # Compute with bom quantity
+        bom_qties = [
+            bom.product_uom_id._compute_quantity(
+                bom.product_qty, bom.product_tmpl_id.uom_id)
+            for __, bom, __ in nodes]
+        if np is None:
             # Find the lowest quantity we can make with the stock at hand
-            components_potential_qty = min(
-                [self._get_component_qty(component) // need
-                 for component, need in component_needs.items()]
-            )
+            return {
+                product_id: bom_qty * min([
+                    quantities[component_id] // need
+                    for component_id, need in needs.items()])
+                for (product_id, __, needs), bom_qty in zip(nodes, bom_qties)
+            }
+        counts = [len(needs) for __, __, needs in nodes]
+        size = sum(counts)
+        available = np.fromiter(
+            (quantities[component_id] for __, __, needs in nodes
+             for component_id in needs), dtype=float, count=size)
+        needed = np.fromiter(
+            (need for __, __, needs in nodes for need in needs.values()),
+            dtype=float, count=size)
+        starts = np.cumsum([0] + counts[:-1])
+        potentials = np.minimum.reduceat(
+            np.floor_divide(available, needed), starts) * bom_qties
+        return dict(zip([product_id for product_id, __, __ in nodes],
+                        potentials.tolist()))
+
+    @api.multi
+    def _compute_potential_qty_buckets(self, date_start=None, buckets=7,
+                                       interval='day'):
+        """ Project the potential quantities over a horizon.
+
+        The components are counted with their projected quantities (see
+        _compute_available_quantities_buckets), plus what can be made of
+        them by then when their potential counts in their quantity. What
+        can be made by the end of a bucket only uses the components
+        available one manufacturing lead time earlier, rounded up to whole
+        buckets.
+        :param date_start: datetime string, the beginning of the first
+            bucket; now if None
+        :param buckets: int, the number of buckets
+        :param interval: str, the length of the buckets: 'day' or 'week'
+        :return: dict with the keys dates, the list of the ends of the
+            buckets, and quantities, a dict {product_id: list of the
+            potential quantities at the end of each bucket}
+        """
+        if interval not in BUCKET_INTERVALS:
+            raise UserError(_('Invalid bucket interval %s') % interval)
+        if not isinstance(buckets, int) or buckets < 1:
+            raise UserError(_('At least one bucket is needed'))
+        start = fields.Datetime.from_string(
+            date_start or fields.Datetime.now())
+        delta = BUCKET_INTERVALS[interval]
+        field = self._get_component_qty_field()
+        recursive = field in ('immediately_usable_qty', 'potential_qty')
+        graph = self._get_potential_graph()
+        components = self._get_potential_graph_components(graph)
+        # One more bucket ending at date_start holds the quantities at hand
+        projection = components._compute_available_quantities_buckets(
+            fields.Datetime.to_string(start - delta), buckets + 1, interval)
+        available = projection['quantities']
+        if field == 'potential_qty':
+            available = {component_id: [0.0] * (buckets + 1)
+                         for component_id in available}
+        product_ids, levels = self._get_potential_levels(graph)
+        potentials = {product_id: [0.0] * (buckets + 1)
+                      for product_id in product_ids}
+        bucket_days = delta.total_seconds() / 86400
+        for nodes in levels:
+            for product_id, bom, needs in nodes:
+                rows = []
+                for component_id, need in needs.items():
+                    quantities = available[component_id]
+                    if recursive:
+                        quantities = [
+                            qty + potential for qty, potential in zip(
+                                quantities, potentials[component_id])]
+                    rows.append((quantities, need))
+                ratios = self._compute_potential_qty_timeline(rows)
+                shift = 0
+                if bom.type != 'phantom':
+                    shift = min(int(math.ceil(
+                        bom.product_tmpl_id.produce_delay / bucket_days)),
+                        buckets + 1)
+                # Compute with bom quantity
+                bom_qty = bom.product_uom_id._compute_quantity(
+                    bom.product_qty, bom.product_tmpl_id.uom_id)
+                potentials[product_id] = [0.0] * shift + [
+                    bom_qty * ratio for ratio in ratios[:buckets + 1 - shift]]
+        return {
+            'dates': projection['dates'][1:],
+            'quantities': {product_id: potentials[product_id][1:]
+                           for product_id in self.ids},
+        }
+
+    @api.model
+    def _compute_potential_qty_timeline(self, rows):
+        """ Return the lowest ratio of quantity to need of the components
+        at each date.
+
+        :param rows: list of tuple (list of the quantities of a component
+            at each date, need of the component)
+        :return: list of the ratios at each date
+        """
+        if np is None:
+            return [min([quantity // need
+                         for quantity, (__, need) in zip(quantities, rows)])
+                    for quantities in zip(*[row[0] for row in rows])]
+        return np.floor_divide(
+            np.array([row[0] for row in rows], dtype=float),
+            np.array([[row[1]] for row in rows], dtype=float),
+        ).min(axis=0).tolist()
+
+    @api.model
+    def _get_allocation_priority(self):
+        """ Return the priority of the products for the allocation of the
+        components: sequence, margin, velocity, or False when the
+        allocated potential is disabled.
+        """
+        icp = self.env['ir.config_parameter'].sudo()
+        return icp.get_param('stock_available_mrp_allocation', False)
+
+    @api.multi
+    def _get_sales_velocities(self, days=VELOCITY_DAYS):
+        """ Return the average quantities delivered to customers per day.
+
+        :param days: int, the number of days in the past to consider
+        :return: dict {product_id: quantity per day}
+        """
+        if not self:
+            return {}
+        date_from = fields.Datetime.to_string(
+            fields.Datetime.from_string(fields.Datetime.now()) -
+            timedelta(days=days))
+        self.env.cr.execute("""
+            SELECT m.product_id, SUM(m.product_qty)
+            FROM stock_move m
+                JOIN stock_location l ON l.id = m.location_dest_id
+            WHERE m.product_id IN %s AND m.state = 'done'
+                AND l.usage = 'customer' AND m.date >= %s
+            GROUP BY m.product_id
+        """, (tuple(self.ids), date_from))
+        return {product_id: qty / days
+                for product_id, qty in self.env.cr.fetchall()}
+
+    @api.multi
+    def _sort_by_allocation_priority(self, priority):
+        """ Return the products sorted by decreasing priority.
 
+        :param priority: str, sequence, margin or velocity
+        :rtype: product_product
+        """
+        if priority == 'sequence':
+            return self.sorted(
+                lambda p: (p.product_tmpl_id.sequence, p.id))
+        if priority == 'margin':
+            return self.sorted(
+                lambda p: (p.standard_price - p.lst_price, p.id))
+        if priority == 'velocity':
+            velocities = self._get_sales_velocities()
+            return self.sorted(
+                lambda p: (-velocities.get(p.id, 0.0), p.id))
+        raise UserError(_('Invalid allocation priority %s') % priority)
+
+    @api.multi
+    def _compute_allocated_potential_qty_dict(self, priority):
+        """ Compute the potential quantities of the products when they
+        compete for the same components.
+
+        The components are allocated greedily: each product, in order of
+        priority, is given as much of the remaining components as it can
+        use, so that the sum of the allocated potentials can actually be
+        manufactured.
+        When the components are counted with their potential, the potential
+        of the sub-assemblies is computed once, before the allocation: the
+        components they share with products of higher priority are not
+        deducted from it, so the allocation is only exact on one level of
+        BoMs.
+        :param priority: str, see _sort_by_allocation_priority
+        :return: dict {product_id: allocated potential quantity}
+        """
+        field = self._get_component_qty_field()
+        bom_needs = self._get_bom_needs()
+        component_ids = set()
+        for __, needs in bom_needs.values():
+            component_ids.update(needs)
+        components = self.browse(sorted(component_ids))
+        remaining = components._get_component_quantities(field)
+        if field in ('immediately_usable_qty', 'potential_qty'):
+            for component_id, qty in components.with_context(
+                    prefetch_fields=False)._compute_potential_qty_dict(
+                    ).items():
+                if component_id in remaining:
+                    remaining[component_id] += qty
+        res = dict.fromkeys(self.ids, 0.0)
+        for product in self._sort_by_allocation_priority(priority):
+            if product.id not in bom_needs:
+                continue
+            bom, needs = bom_needs[product.id]
+            needs = {component_id: need
+                     for component_id, need in needs.items() if need > 0}
+            if not needs:
+                continue
+            batches = min([remaining[component_id] // need
+                           for component_id, need in needs.items()])
+            if batches <= 0:
+                continue
+            for component_id, need in needs.items():
+                remaining[component_id] -= batches * need
             # Compute with bom quantity
-            bom_qty = bom.product_uom_id._compute_quantity(
-                bom.product_qty,
-                bom.product_tmpl_id.uom_id
-            )
-            return bom_qty * components_potential_qty
+            res[product.id] = batches * bom.product_uom_id._compute_quantity(
+                bom.product_qty, bom.product_tmpl_id.uom_id)
+        return res
+
+    @api.multi
+    def action_open_allocated_components(self):
+        """ Open the stock of the components the allocated potential of the
+        products is computed from. """
+        component_ids = set()
+        for __, needs in self._get_bom_needs().values():
+            component_ids.update(needs)
+        result = self.env.ref('stock.product_open_quants').read()[0]
+        result['domain'] = [('product_id', 'in', sorted(component_ids))]
+        result['context'] = {
+            'search_default_productgroup': 1,
+            'search_default_internal_loc': 1,
+        }
+        return result
+
+    @api.model
+    def _cron_compute_allocated_potential_qty(self):
+        """ Store the allocated potential of all the products having a BoM.
+
+        :return: int, the number of products having an allocated potential
+        """
+        priority = self._get_allocation_priority()
+        if not priority:
+            return 0
+        products = self.search([('product_tmpl_id.bom_ids', '!=', False)])
+        res = {product_id: qty for product_id, qty in
+               products._compute_allocated_potential_qty_dict(
+                   priority).items() if qty}
+        cr = self.env.cr
+        cr.execute("""
+            UPDATE product_product SET allocated_potential_qty = 0
+            WHERE allocated_potential_qty != 0 AND NOT id = ANY(%s)
+        """, (list(res),))
+        if res:
+            cr.execute("""
+                UPDATE product_product p SET allocated_potential_qty = a.qty
+                FROM unnest(%s, %s) AS a(product_id, qty)
+                WHERE p.id = a.product_id
+            """, (list(res), list(res.values())))
+        self.invalidate_cache(['allocated_potential_qty'])
+        _logger.info(
+            "Allocated the components of %d products by %s: %d can be "
+            "manufactured", len(products), priority, len(res))
+        return len(res)
+
+    @api.model
+    def _get_component_qty_field(self):
+        """ Return the field of the components the potential is based on.
+
+        :rtype: str
+        """
+        icp = self.env['ir.config_parameter'].sudo()
+        return icp.get_param('stock_available_mrp_based_on', 'qty_available')
 
     def _get_component_qty(self, component):
         """ Return the component qty to use based en company settings.
@@ -80,48 +726,32 @@ class ProductProduct(models.Model):
         :type component: product_product
         :rtype: float
         """
-        icp = self.env['ir.config_parameter'].sudo()
-        stock_available_mrp_based_on = icp.get_param(
-            'stock_available_mrp_based_on', 'qty_available'
-        )
-
-        return component[stock_available_mrp_based_on]
+        return component[self._get_component_qty_field()]
 
     def _get_components_needs(self, product, bom):
         """ Return the needed qty of each compoments in the *bom* of *product*.
 
+        The needs are read from the flattened BoMs instead of exploding the
+        BoM each time.
         :type product: product_product
         :type bom: mrp_bom
         :rtype: collections.Counter
         """
-        needs = Counter()
-        for bom_component in bom.explode(product, 1.0)[1]:
-            component = bom_component[0]['product_id']
-            try:
-                line_uom = bom_component[0].product_uom_id
-                component_qty = line_uom._compute_quantity(
-                    bom_component[1]['original_qty'],
-                    component.uom_id
-                )
-            except UserError:
-                # This occurs, when we have components
-                # which are in a different cateogry.
-                continue
-            component_qty = component_qty * bom_component[1]['qty']
-            needs += Counter(
-                {component: component_qty}
-            )
-
-        return needs
+        # The flattened BoMs are read in SQL: check the user may read BoMs
+        self.env['mrp.bom.line'].check_access_rights('read')
+        needs = self.env['mrp.bom.flat']._get_needs([(bom, product)])
+        return Counter({
+            self.browse(component_id): qty
+            for component_id, qty in needs[(bom.id, product.id)].items()
+        })
 
+    @api.multi
     def _get_component_ids(self):
         """ Compute component_ids by getting all the components for
         this product.
         """
-        bom_obj = self.env['mrp.bom']
-
-        bom_id = bom_obj._bom_find(product_id=self.id)
-        if bom_id:
-            bom = bom_obj.browse(bom_id)
-            for bom_component in bom_obj._bom_explode(bom, self, 1.0)[0]:
-                self.component_ids |= self.browse(bom_component['product_id'])
+        bom_needs = self._get_bom_needs()
+        for product in self:
+            node = bom_needs.get(product.id)
+            product.component_ids = self.browse(
+                sorted(node[1]) if node else [])
@@ -1,7 +1,13 @@
 # Copyright 2014 Numérigraphe SARL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo import models, api
+from odoo import _, api, models
+from odoo.addons.stock_available.models.product_product import (
+    OPERATORS, ROUND_QTY_SQL)
+
+from .product_product import UNDECIDED_OPERATORS
+from odoo.exceptions import UserError
+from odoo.osv import expression
 
 
 class ProductTemplate(models.Model):
@@ -33,3 +39,65 @@ class ProductTemplate(models.Model):
                 'potential_qty': potential
             }
         return res
+
+    @api.model
+    def _search_immediately_usable_qty(self, operator, value):
+        """Like the computation, take the biggest quantity of the variants
+        of the templates instead of their sum in the SQL search of
+        stock_available. As for the variants, only the templates having a
+        BoM that the SQL search can't decide are filtered in python."""
+        parts = self.env[
+            'product.product']._get_immediately_usable_qty_sql_parts()
+        if parts is None:
+            return super()._search_immediately_usable_qty(operator, value)
+        if operator not in OPERATORS:
+            raise UserError(_('Invalid domain operator %s') % operator)
+        if not isinstance(value, (float, int)):
+            raise UserError(_('Invalid domain right operand %s') % value)
+        domain = self._search_immediately_usable_qty_sql(
+            operator, value, parts)
+        undecided_templates = self.search(expression.AND([
+            [('bom_ids', '!=', False)],
+            self._search_immediately_usable_qty_sql(
+                UNDECIDED_OPERATORS[operator], value, parts),
+        ]))
+        if not undecided_templates:
+            return domain
+        matching_templates = undecided_templates.filtered(
+            lambda t: OPERATORS[operator](t.immediately_usable_qty, value))
+        return expression.OR([
+            expression.AND([
+                [('id', 'not in', undecided_templates.ids)], domain]),
+            [('id', 'in', matching_templates.ids)],
+        ])
+
+    @api.model
+    def _search_immediately_usable_qty_sql(self, operator, value, parts):
+        """Search the templates on the biggest quantity of their variants
+        summed up in SQL, rounded to their unit of measure.
+        :param operator: str
+        :param value: float
+        :param parts: list of tuple (query, params), see
+            _get_immediately_usable_qty_sql_parts
+        :return: list of tuple (domain)
+        """
+        # The templates without active variants are available for 0
+        query = """
+            SELECT pt.id
+            FROM product_template pt
+                JOIN product_uom uom ON uom.id = pt.uom_id
+                LEFT JOIN product_product pp
+                    ON pp.product_tmpl_id = pt.id AND pp.active
+                LEFT JOIN (
+                    SELECT atp.product_id, SUM(atp.quantity) AS quantity
+                    FROM (%s) AS atp
+                    GROUP BY atp.product_id
+                ) AS atp ON atp.product_id = pp.id
+            GROUP BY pt.id, uom.rounding
+            HAVING MAX(%s) %s %%s
+        """ % (' UNION ALL '.join(part[0] for part in parts),
+               ROUND_QTY_SQL % {'qty': 'COALESCE(atp.quantity, 0)',
+                                'rounding': 'uom.rounding'},
+               operator)
+        params = [param for part in parts for param in part[1]] + [value]
+        return [('id', 'inselect', (query, params))]
@@ -0,0 +1,41 @@
+# Copyright 2018 Numérigraphe SARL
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import api, models, tools
+
+# Fields changing the conversions between the Units of Measure
+UOM_CONVERSION_FIELDS = ('category_id', 'factor', 'factor_inv', 'uom_type',
+                         'rounding')
+
+
+class ProductUom(models.Model):
+    _inherit = 'product.uom'
+
+    @api.model
+    @tools.ormcache('from_uom_id', 'to_uom_id')
+    def _get_conversion_factor(self, from_uom_id, to_uom_id):
+        """ Return the quantity of 1 unit of a UoM in another one.
+
+        The factors are cached: they are used for all the lines of all the
+        BoMs flattened.
+        :return: float, or None when the UoMs are in different categories
+        """
+        from_uom = self.browse(from_uom_id)
+        to_uom = self.browse(to_uom_id)
+        if from_uom.category_id != to_uom.category_id:
+            return None
+        return from_uom._compute_quantity(1.0, to_uom)
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if any(field in vals for field in UOM_CONVERSION_FIELDS):
+            self.clear_caches()
+            self.env['mrp.bom.flat']._invalidate()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self.clear_caches()
+        return res
@@ -1,9 +1,16 @@
 # Copyright 2014 Numérigraphe SARL
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from datetime import timedelta
+from unittest import mock
+
+from odoo import fields
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
 from odoo.osv.expression import TRUE_LEAF
 
+from ..models import product_product
+
 
 class TestPotentialQty(TransactionCase):
     """Test the potential quantity on a product with a multi-line BoM"""
@@ -551,3 +558,336 @@ class TestPotentialQty(TransactionCase):
             {p1.id: 3.0, p2.id: 3.0, p3.id: 0.0},
             {p.id: p.potential_qty for p in products}
         )
+
+    def test_flattened_bom(self):
+        # The needs are stored once per BoM and product, and forgotten when
+        # the BoMs change
+        flat_model = self.env['mrp.bom.flat']
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        p3 = self.product_model.create({'name': 'Test P3', 'type': 'product'})
+        bom_p1 = self.create_simple_bom(p1, p2, sub_product_qty=2)
+        bom_p2 = self.create_simple_bom(p2, p3)
+        self.create_inventory(p2.id, 8)
+        self.create_inventory(p3.id, 5)
+
+        self.product_model.invalidate_cache()
+        self.assertEqual(4.0, p1.potential_qty)
+        self.assertEqual(5.0, p2.potential_qty)
+        flat_p1 = flat_model.search([('bom_id', '=', bom_p1.id),
+                                     ('product_id', '=', p1.id)])
+        self.assertEqual(1, len(flat_p1))
+        self.assertEqual(p2, flat_p1.line_ids.component_id)
+        self.assertEqual(2.0, flat_p1.line_ids.product_qty)
+
+        # Changing a line only forgets its BoM
+        bom_p1.bom_line_ids.write({'product_qty': 4})
+        self.assertFalse(flat_p1.exists())
+        self.assertTrue(flat_model.search([('bom_id', '=', bom_p2.id)]))
+        self.product_model.invalidate_cache()
+        self.assertEqual(2.0, p1.potential_qty)
+
+        # Sets may be part of any BoM: turning one into a set forgets all
+        bom_p2.type = 'phantom'
+        self.assertFalse(flat_model.search([]))
+        self.product_model.invalidate_cache()
+        self.assertEqual(1.0, p1.potential_qty)
+        self.assertEqual(
+            p3, flat_model.search([('bom_id', '=', bom_p1.id)]).mapped(
+                'line_ids.component_id'))
+
+        # A normal BoM taking over the set forgets the BoMs exploded through
+        # the set
+        bom_p2.sequence = 10
+        self.product_model.invalidate_cache()
+        self.assertEqual(1.0, p1.potential_qty)
+        bom_p2b = self.create_simple_bom(p2, p3)
+        bom_p2b.sequence = 1
+        self.assertFalse(flat_model.search([('bom_id', '=', bom_p1.id)]))
+        self.product_model.invalidate_cache()
+        self.assertEqual(2.0, p1.potential_qty)
+        self.assertEqual(
+            p2, flat_model.search([('bom_id', '=', bom_p1.id)]).mapped(
+                'line_ids.component_id'))
+
+    def test_potential_qty_graph(self):
+        # Sub-assemblies shared by several products are computed once, in
+        # a single bottom-up pass, and cycles of BoMs don't loop forever
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        p3 = self.product_model.create({'name': 'Test P3', 'type': 'product'})
+        p4 = self.product_model.create({'name': 'Test P4', 'type': 'product'})
+        p5 = self.product_model.create({'name': 'Test P5', 'type': 'product'})
+
+        self.config.set_param('stock_available_mrp_based_on',
+                              'immediately_usable_qty')
+
+        # P1 needs one P2 and two P3, both made of one P4, made of one P5
+        bom_p1 = self.create_simple_bom(p1, p2)
+        self.bom_line_model.create({
+            'bom_id': bom_p1.id,
+            'product_id': p3.id,
+            'product_qty': 2,
+        })
+        self.create_simple_bom(p2, p4)
+        self.create_simple_bom(p3, p4)
+        self.create_simple_bom(p4, p5)
+        self.create_inventory(p5.id, 10)
+        self.create_inventory(p3.id, 4)
+
+        products = p1 | p2 | p3 | p4 | p5
+        graph = p1._get_potential_graph()
+        self.assertEqual(set(products.ids), set(graph))
+        order = self.product_model._sort_potential_graph(graph)
+        self.assertLess(order.index(p5.id), order.index(p4.id))
+        self.assertLess(order.index(p4.id), order.index(p2.id))
+        self.assertLess(order.index(p3.id), order.index(p1.id))
+
+        self.assertEqual(
+            {p1.id: 7.0, p2.id: 10.0, p3.id: 10.0, p4.id: 10.0, p5.id: 0.0},
+            products._compute_potential_qty_dict())
+
+        # P5 made of P1 closes a cycle
+        self.create_simple_bom(p5, p1)
+        res = products._compute_potential_qty_dict()
+        self.assertEqual(set(products.ids), set(res))
+
+    def test_potential_qty_batch(self):
+        # The vectorized computation matches the python one
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        bom = self.create_simple_bom(p1, p2, product_qty=2)
+        nodes = [
+            (p1.id, bom, {10: 2.0, 11: 3.0}),
+            (p2.id, bom, {10: 1.0}),
+        ]
+        quantities = {10: 7.0, 11: -4.0}
+        expected = {p1.id: -4.0, p2.id: 14.0}
+        self.assertEqual(
+            expected,
+            self.product_model._compute_potential_qty_batch(
+                nodes, quantities))
+        with mock.patch.object(product_product, 'np', None):
+            self.assertEqual(
+                expected,
+                self.product_model._compute_potential_qty_batch(
+                    nodes, quantities))
+
+    def test_where_used(self):
+        # P1 is made of P2, made of P3, made of P4 through a set
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        p3 = self.product_model.create({'name': 'Test P3', 'type': 'product'})
+        p4 = self.product_model.create({'name': 'Test P4', 'type': 'product'})
+        self.create_simple_bom(p1, p2)
+        self.create_simple_bom(p2, p3)
+        self.create_simple_bom(p3, p4).type = 'phantom'
+
+        self.assertEqual(p2 | p3, p4._get_where_used())
+        self.assertEqual(p1, p2._get_where_used())
+        # The components of the sets are the components of the product
+        self.assertEqual(p4, p2.component_ids)
+        self.assertEqual(p2, p1.component_ids)
+
+        self.config.set_param('stock_available_mrp_based_on',
+                              'immediately_usable_qty')
+        self.assertEqual(p1 | p2 | p3, p4._get_where_used())
+
+    def test_component_quantities(self):
+        # The quantities of the components are read in one batch
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        self.create_inventory(p1.id, 3)
+        self.create_inventory(p2.id, 5)
+        components = p1 | p2
+        for field in ('qty_available', 'virtual_available'):
+            self.assertEqual(
+                {p1.id: 3.0, p2.id: 5.0},
+                components._get_component_quantities(field))
+        self.assertEqual(
+            {p1.id: 0.0, p2.id: 0.0},
+            components._get_component_quantities('potential_qty'))
+
+        product_model = type(self.product_model)
+        with mock.patch.object(
+                product_model, '_compute_quantities_dict', autospec=True,
+                side_effect=product_model._compute_quantities_dict) as spy:
+            components._get_component_quantities('immediately_usable_qty')
+        self.assertEqual(1, spy.call_count)
+
+    def test_allocated_potential_qty(self):
+        # P1 and P2 compete for P3: their potentials can't be summed up
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        p3 = self.product_model.create({'name': 'Test P3', 'type': 'product'})
+        p4 = self.product_model.create({'name': 'Test P4', 'type': 'product'})
+        self.create_simple_bom(p1, p3, sub_product_qty=2)
+        self.create_simple_bom(p2, p3)
+        self.create_simple_bom(p4, p2)
+        self.create_inventory(p3.id, 5)
+        p1.product_tmpl_id.sequence = 2
+        p2.product_tmpl_id.sequence = 1
+        p1.write({'lst_price': 10, 'standard_price': 2})
+        p2.write({'lst_price': 10, 'standard_price': 5})
+
+        self.product_model.invalidate_cache()
+        self.assertEqual(2.0, p1.potential_qty)
+        self.assertEqual(5.0, p2.potential_qty)
+
+        products = p1 | p2 | p4
+        self.assertEqual(
+            {p1.id: 0.0, p2.id: 5.0, p4.id: 0.0},
+            products._compute_allocated_potential_qty_dict('sequence'))
+        self.assertEqual(
+            {p1.id: 2.0, p2.id: 1.0, p4.id: 0.0},
+            products._compute_allocated_potential_qty_dict('margin'))
+
+        # Disabled by default
+        self.assertEqual(
+            0, self.product_model._cron_compute_allocated_potential_qty())
+        self.config.set_param('stock_available_mrp_allocation', 'margin')
+        self.product_model._cron_compute_allocated_potential_qty()
+        self.assertEqual(2.0, p1.allocated_potential_qty)
+        self.assertEqual(1.0, p2.allocated_potential_qty)
+        self.assertEqual(0.0, p4.allocated_potential_qty)
+        # The button lists the stock of the components
+        self.assertEqual(
+            [('product_id', 'in', sorted((p2 | p3).ids))],
+            products.action_open_allocated_components()['domain'])
+
+    def test_potential_qty_by_warehouse(self):
+        # The potential in each warehouse is the one computed in the
+        # context of the warehouse
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        self.create_simple_bom(p1, p2, sub_product_qty=2)
+        self.create_inventory(p2.id, 6)
+        self.create_inventory(p2.id, 3, self.wh_ch.lot_stock_id.id)
+        warehouses = self.wh_main | self.wh_ch
+
+        potentials = p1._compute_potential_qty_by_warehouse(warehouses)
+        self.assertEqual(
+            {(p1.id, self.wh_main.id): 3.0, (p1.id, self.wh_ch.id): 1.0},
+            potentials)
+        for warehouse in warehouses:
+            self.assertEqual(
+                potentials[(p1.id, warehouse.id)],
+                p1.with_context(warehouse=warehouse.id).potential_qty)
+
+        res = p1._compute_available_quantities_by_warehouse(warehouses)
+        self.assertEqual(1.0, res[(p1.id, self.wh_ch.id)]['potential_qty'])
+        self.assertEqual(
+            1.0, res[(p1.id, self.wh_ch.id)]['immediately_usable_qty'])
+
+    def test_potential_qty_buckets(self):
+        # The receipts of components count once the product can be made of
+        # them, one manufacturing lead time later
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product',
+                                        'produce_delay': 2})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        self.create_simple_bom(p1, p2, sub_product_qty=2)
+        self.create_inventory(p2.id, 2)
+        start = fields.Datetime.from_string('2018-01-01 00:00:00')
+        self.env['stock.move'].create({
+            'name': 'Receipt of P2',
+            'location_id': self.ref('stock.stock_location_suppliers'),
+            'location_dest_id': self.wh_main.lot_stock_id.id,
+            'product_id': p2.id,
+            'product_uom': p2.uom_id.id,
+            'product_uom_qty': 6,
+            'date_expected': fields.Datetime.to_string(
+                start + timedelta(days=3, hours=1)),
+        })._action_confirm()
+
+        res = p1._compute_potential_qty_buckets(
+            fields.Datetime.to_string(start), buckets=6)
+        self.assertEqual('2018-01-02 00:00:00', res['dates'][0])
+        self.assertEqual([0.0, 1.0, 1.0, 1.0, 1.0, 4.0],
+                         res['quantities'][p1.id])
+
+        with self.assertRaises(UserError):
+            p1._compute_potential_qty_buckets(interval='month')
+        for buckets in (0, -1, '7'):
+            with self.assertRaises(UserError):
+                p1._compute_potential_qty_buckets(buckets=buckets)
+
+    def test_uom_conversion_factors(self):
+        # The conversion factors are computed once, and the lines in a UoM
+        # of another category are reported
+        uom_model = self.env['product.uom']
+        unit = self.env.ref('product.product_uom_unit')
+        dozen = self.env.ref('product.product_uom_dozen')
+        kgm = self.env.ref('product.product_uom_kgm')
+        self.assertEqual(
+            12.0, uom_model._get_conversion_factor(dozen.id, unit.id))
+        self.assertIsNone(uom_model._get_conversion_factor(kgm.id, unit.id))
+
+        p1 = self.product_model.create({'name': 'Test P1', 'type': 'product'})
+        p2 = self.product_model.create({'name': 'Test P2', 'type': 'product'})
+        p3 = self.product_model.create({'name': 'Test P3', 'type': 'product'})
+        bom = self.create_simple_bom(p1, p2)
+        bom.bom_line_ids.product_uom_id = dozen
+        self.bom_line_model.create({
+            'bom_id': bom.id,
+            'product_id': p3.id,
+            'product_qty': 1,
+            'product_uom_id': kgm.id,
+        })
+        self.create_inventory(p2.id, 36)
+
+        self.product_model.invalidate_cache()
+        self.assertEqual(3.0, p1.potential_qty)
+        self.assertEqual(
+            [(bom, p1, p3, kgm)],
+            [error for error in self.env['mrp.bom.flat']._get_uom_errors()
+             if error[0] == bom])
+
+    def test_search_product_with_bom(self):
+        """The products having a BoM are searched on their stock and their
+        potential, whether the SQL search decides or not"""
+        product = self.product_model.create(
+            {'name': 'Searched product', 'type': 'product'})
+        component = self.product_model.create(
+            {'name': 'Searched component', 'type': 'product'})
+        self.create_simple_bom(product, component)
+        self.create_inventory(product.id, 2)
+        self.create_inventory(component.id, 3)
+        product.invalidate_cache()
+        self.assertEqual(product.immediately_usable_qty, 5)
+        for operator, value, found in (('=', 5, product),
+                                       ('=', 2, self.product_model),
+                                       ('!=', 2, product),
+                                       ('>', 4, product),
+                                       ('>', 1, product),
+                                       ('>=', 6, self.product_model),
+                                       ('<', 3, self.product_model),
+                                       ('<=', 5, product)):
+            self.assertEqual(
+                self.product_model.search([
+                    ('id', '=', product.id),
+                    ('immediately_usable_qty', operator, value)]),
+                found, "%s %s" % (operator, value))
+
+    def test_search_template_without_bom(self):
+        """The templates without BoM are searched on the biggest quantity
+        of their variants, like they are computed"""
+        tmpl = self.env['product.template'].create(
+            {'name': 'Template without BoM', 'type': 'product'})
+        var1 = tmpl.product_variant_ids
+        var2 = self.product_model.create(
+            {'name': 'Second variant', 'type': 'product',
+             'product_tmpl_id': tmpl.id})
+        self.create_inventory(var1.id, 5)
+        self.create_inventory(var2.id, 3)
+        tmpl.invalidate_cache()
+        self.assertEqual(tmpl.immediately_usable_qty, 5)
+        template_model = self.env['product.template']
+        for operator, value, found in (('=', 5, tmpl),
+                                       ('=', 8, template_model),
+                                       ('>', 4, tmpl),
+                                       ('<', 5, template_model)):
+            self.assertEqual(
+                template_model.search([
+                    ('id', '=', tmpl.id),
+                    ('immediately_usable_qty', operator, value)]),
+                found)
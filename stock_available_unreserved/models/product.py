@@ -4,6 +4,8 @@
 #   (http://www.eficent.com)
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
+from array import array
+
 from odoo import api, fields, models, _
 from odoo.addons import decimal_precision as dp
 from odoo.addons.stock.models.product import OPERATORS
@@ -36,24 +38,37 @@ class ProductTemplate(models.Model):
     @api.multi
     def action_open_quants_unreserved(self):
         products_ids = self.mapped('product_variant_ids').ids
-        quants = self.env['stock.quant'].search([
-            ('product_id', 'in', products_ids),
-        ])
-        quant_ids = quants.filtered(
-            lambda x: x.product_id.qty_available_not_res > 0
-        ).ids
         result = self.env.ref('stock.product_open_quants').read()[0]
-        result['domain'] = [('id', 'in', quant_ids)]
+        result['domain'] = [
+            ('product_id', 'in', products_ids),
+            ('has_unreserved_quantity', '=', True),
+        ]
         result['context'] = {
             'search_default_locationgroup': 1,
             'search_default_internal_loc': 1,
         }
         return result
 
+    @api.model
     def _search_quantity_unreserved(self, operator, value):
-        domain = [('qty_available_not_res', operator, value)]
-        product_variant_ids = self.env['product.product'].search(domain)
-        return [('product_variant_ids', 'in', product_variant_ids.ids)]
+        """ Search function for the qty_available_not_res field.
+        Like the searches on the quantities in the Odoo core, a template
+        matches when any of its active variants matches: the query of
+        _get_quantity_unreserved_search_query is used as a subquery, instead
+        of searching the variants first.
+        :param operator: str
+        :param value: str
+        :return: list of tuple (domain)
+        """
+        query, params, negate = self.env[
+            'product.product']._get_quantity_unreserved_search_query(
+                operator, value)
+        query = """
+            SELECT pp.product_tmpl_id
+            FROM product_product pp
+            WHERE pp.active AND pp.id %s (%s)
+        """ % ('NOT IN' if negate else 'IN', query)
+        return [('id', 'inselect', (query, params))]
 
 
 class ProductProduct(models.Model):
@@ -76,23 +91,128 @@ class ProductProduct(models.Model):
         return domain_quant
 
     @api.multi
-    def _compute_product_available_not_res_dict(self):
-
-        res = {}
+    def _read_group_unreserved(self, groupby):
+        """ Sum up the unreserved quantity of the quants of the products in
+        the locations of the context.
 
+        :param groupby: list of str, the fields of stock.quant to group by,
+            starting with product_id
+        :return: dict {tuple of the ids of the groupby fields, False when
+            empty: unreserved quantity}, not rounded
+        """
         domain_quant = self._prepare_domain_available_not_reserved()
         quants = self.env['stock.quant'].with_context(lang=False).read_group(
             domain_quant,
-            ['product_id', 'location_id', 'quantity', 'reserved_quantity'],
-            ['product_id', 'location_id'],
+            groupby + ['quantity', 'reserved_quantity'],
+            groupby,
             lazy=False)
-        product_sums = {}
+        res = {}
         for quant in quants:
+            key = tuple(quant[field] and quant[field][0]
+                        for field in groupby)
+            res[key] = res.get(key, 0.0) + (
+                quant['quantity'] - quant['reserved_quantity'])
+        return res
+
+    @api.multi
+    def _get_unreserved_quantities_by_location(self, lot=False,
+                                               package=False):
+        """ Return the unreserved quantity of the products per location of
+        the context holding some quants, and optionally per lot and package.
+
+        :param lot: bool, whether to detail the quantities per lot
+        :param package: bool, whether to detail the quantities per package
+        :return: dict {(product_id, location_id[, lot_id][, package_id]):
+            unreserved quantity}, with False for the quants without lot or
+            package
+        """
+        groupby = ['product_id', 'location_id']
+        if lot:
+            groupby.append('lot_id')
+        if package:
+            groupby.append('package_id')
+        quantities = self._read_group_unreserved(groupby)
+        roundings = {
+            product.id: product.uom_id.rounding
+            for product in self.with_context(prefetch_fields=False, lang='')
+        }
+        return {
+            key: float_round(qty, precision_rounding=roundings[key[0]])
+            for key, qty in quantities.items()
+        }
+
+    @api.multi
+    def _get_unreserved_quantities_by_lot(self, removal_order=False):
+        """ Return the unreserved quantity of the products per lot and
+        package in the locations of the context, in one query.
+
+        The rows are sorted by product, then by lot and package. With
+        *removal_order*, the lots of each product are sorted by removal
+        date first, when the lots have one (see product_expiry), so that
+        the lots to pick first come first.
+        :param removal_order: bool, whether to sort the lots by removal date
+        :return: dict of parallel arrays: 'product_ids', 'lot_ids' and
+            'package_ids' of type 'i', with 0 for the quants without lot or
+            package, and 'quantities' of type 'd'. When the lots have a
+            removal date, 'removal_dates' is a list of the removal dates,
+            False when unknown.
+        """
+        res = {
+            'product_ids': array('i'),
+            'lot_ids': array('i'),
+            'package_ids': array('i'),
+            'quantities': array('d'),
+        }
+        with_removal_date = (
+            'removal_date' in self.env['stock.production.lot']._fields)
+        if with_removal_date:
+            res['removal_dates'] = []
+        if not self.ids:
+            return res
+        sql, params = self._get_quantity_unreserved_sql(
+            [('product_id', 'in', self.ids)], ['lot_id', 'package_id'])
+        query = """
+            SELECT unreserved.product_id, COALESCE(unreserved.lot_id, 0),
+                COALESCE(unreserved.package_id, 0),
+                SUM(unreserved.quantity)%s
+            FROM (%s) AS unreserved%s
+            GROUP BY unreserved.product_id, unreserved.lot_id,
+                unreserved.package_id
+            ORDER BY 1, %s 2, 3
+        """ % (
+            ', MIN(lot.removal_date)' if with_removal_date else '',
+            sql,
+            ' LEFT JOIN stock_production_lot lot'
+            ' ON lot.id = unreserved.lot_id' if with_removal_date else '',
+            '5,' if with_removal_date and removal_order else '')
+        self.env.cr.execute(query, params)
+        roundings = {
+            product.id: product.uom_id.rounding
+            for product in self.with_context(prefetch_fields=False, lang='')
+        }
+        for row in self.env.cr.fetchall():
+            res['product_ids'].append(row[0])
+            res['lot_ids'].append(row[1])
+            res['package_ids'].append(row[2])
+            res['quantities'].append(float_round(
+                row[3], precision_rounding=roundings[row[0]]))
+            if with_removal_date:
+                res['removal_dates'].append(
+                    fields.Datetime.to_string(row[4]) if row[4] else False)
+        return res
+
+    @api.multi
+    def _compute_product_available_not_res_dict(self):
+
+        res = {}
+
+        quantities = self._read_group_unreserved(
+            ['product_id', 'location_id'])
+        product_sums = {}
+        for (product_id, __), qty in quantities.items():
             # create a dictionary with the total value per products
-            product_sums.setdefault(quant['product_id'][0], 0.)
-            product_sums[quant['product_id'][0]] += (
-                quant['quantity'] - quant['reserved_quantity']
-            )
+            product_sums.setdefault(product_id, 0.)
+            product_sums[product_id] += qty
         for product in self.with_context(prefetch_fields=False, lang=''):
             available_not_res = float_round(
                 product_sums.get(product.id, 0.0),
@@ -111,14 +231,71 @@ class ProductProduct(models.Model):
             prod.qty_available_not_res = qty
         return res
 
-    def _search_quantity_unreserved(self, operator, value):
+    @api.model
+    def _get_quantity_unreserved_sql(self, domain=None, columns=()):
+        """ Return a query selecting (product_id, quantity) of the unreserved
+        quantity of the quants in the locations of the context.
+
+        The quants are filtered with the access rules applied, like
+        read_group does in _compute_product_available_not_res_dict.
+        :param domain: list of tuple (domain) restricting the quants
+        :param columns: list of str, columns of stock_quant to select between
+            product_id and quantity
+        :return: tuple (query, params)
+        """
+        quant_obj = self.env['stock.quant']
+        query = quant_obj._where_calc(
+            list(domain or []) + list(self._get_domain_locations()[0]))
+        quant_obj._apply_ir_rules(query, 'read')
+        from_clause, where_clause, params = query.get_sql()
+        sql = """
+            SELECT "stock_quant".product_id, %s
+                "stock_quant".quantity - "stock_quant".reserved_quantity
+                    AS quantity
+            FROM %s""" % (
+            ''.join('"stock_quant"."%s", ' % column for column in columns),
+            from_clause)
+        if where_clause:
+            sql += ' WHERE %s' % where_clause
+        return sql, params
+
+    @api.model
+    def _get_quantity_unreserved_search_query(self, operator, value):
+        """ Return the query selecting the ids of the products whose
+        unreserved quantity matches the condition, or doesn't.
+
+        The unreserved quantities are summed up per product in SQL.
+        Products without any quant are unreserved for 0: when 0 matches the
+        condition, the query selects the products whose quantity doesn't
+        match instead, and *negate* is True.
+        :param operator: str
+        :param value: str
+        :return: tuple (query, params, negate)
+        """
         if operator not in OPERATORS:
             raise UserError(_('Invalid domain operator %s') % operator)
         if not isinstance(value, (float, int)):
             raise UserError(_('Invalid domain right operand %s') % value)
+        negate = OPERATORS[operator](0.0, value)
+        sql, params = self._get_quantity_unreserved_sql()
+        query = """
+            SELECT unreserved.product_id
+            FROM (%s) AS unreserved
+            GROUP BY unreserved.product_id
+            HAVING %s(SUM(unreserved.quantity) %s %%s)
+        """ % (sql, 'NOT ' if negate else '', operator)
+        return query, list(params) + [value], negate
 
-        ids = []
-        for product in self.search([]):
-            if OPERATORS[operator](product.qty_available_not_res, value):
-                ids.append(product.id)
-        return [('id', 'in', ids)]
+    @api.model
+    def _search_quantity_unreserved(self, operator, value):
+        """ Search function for the qty_available_not_res field, see
+        _get_quantity_unreserved_search_query.
+        :param operator: str
+        :param value: str
+        :return: list of tuple (domain)
+        """
+        query, params, negate = self._get_quantity_unreserved_search_query(
+            operator, value)
+        if negate:
+            return [('id', 'not inselect', (query, params))]
+        return [('id', 'inselect', (query, params))]
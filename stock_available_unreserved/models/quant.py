@@ -1,7 +1,8 @@
 # Copyright 2018 Camptocamp SA
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl.html).
 
-from odoo import api, fields, models
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
 
 
 class StockQuant(models.Model):
@@ -12,6 +13,12 @@ class StockQuant(models.Model):
         compute="_compute_contains_unreserved",
         store=True,
     )
+    has_unreserved_quantity = fields.Boolean(
+        string="Has unreserved quantity",
+        compute="_compute_has_unreserved_quantity",
+        search="_search_has_unreserved_quantity",
+        help="The quantity of this quant is not entirely reserved.",
+    )
 
     @api.depends('product_id', 'location_id', 'quantity', 'reserved_quantity')
     def _compute_contains_unreserved(self):
@@ -21,3 +28,19 @@ class StockQuant(models.Model):
                 record.location_id,
             )
             record.contains_unreserved = True if available > 0 else False
+
+    @api.depends('quantity', 'reserved_quantity')
+    def _compute_has_unreserved_quantity(self):
+        for record in self:
+            record.has_unreserved_quantity = (
+                record.quantity > record.reserved_quantity)
+
+    def _search_has_unreserved_quantity(self, operator, value):
+        if operator not in ('=', '!='):
+            raise UserError(_('Invalid domain operator %s') % operator)
+        query = """
+            SELECT id FROM stock_quant WHERE quantity > reserved_quantity
+        """
+        if (operator == '=') == bool(value):
+            return [('id', 'inselect', (query, []))]
+        return [('id', 'not inselect', (query, []))]
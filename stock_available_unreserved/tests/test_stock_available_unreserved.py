@@ -339,3 +339,158 @@ class TestStockLogisticsWarehouse(SavepointCase):
         self.check_template_found_correctly('<', 2, self.templateAB)
         self.check_template_found_correctly('<', 1, self.templateAB)
         self.check_template_found_correctly('<', 0, no_template)
+
+    def test_stock_search_locations(self):
+        self.env['stock.quant'].create(
+            {'location_id': self.bin_a.id,
+             'company_id': self.main_company.id,
+             'product_id': self.productA.id,
+             'quantity': 10.0})
+        self.env['stock.quant'].create(
+            {'location_id': self.bin_b.id,
+             'company_id': self.main_company.id,
+             'product_id': self.productA.id,
+             'quantity': 5.0})
+        self.env['stock.quant'].create(
+            {'location_id': self.bin_b.id,
+             'company_id': self.main_company.id,
+             'product_id': self.productB.id,
+             'quantity': 5.0})
+        b_and_c = self.productB + self.productC
+        self.check_variants_found_correctly('=', 15, self.productA)
+        self.check_variants_found_correctly('<=', 5, b_and_c)
+        # Only the quants of the location of the context are counted
+        bin_a_products = self.env['product.product'].with_context(
+            location=self.bin_a.id)
+        domain = [('id', 'in', self.templateAB.product_variant_ids.ids)]
+        self.check_found_correctly(bin_a_products, domain, '=', 10,
+                                   self.productA)
+        self.check_found_correctly(bin_a_products, domain, '=', 0, b_and_c)
+        self.check_found_correctly(bin_a_products, domain, '!=', 0,
+                                   self.productA)
+
+    def test_open_quants_unreserved(self):
+        self.pickingInA.action_confirm()
+        self.pickingInA.action_assign()
+        self.pickingInA.button_validate()
+        self.pickingInB.action_done()
+        self.pickingOutA.action_confirm()
+        self.pickingOutA.action_assign()
+        quant_obj = self.env['stock.quant']
+        internal_quants = quant_obj.search([
+            ('product_id', 'in', self.templateAB.product_variant_ids.ids),
+            ('location_id.usage', '=', 'internal'),
+        ])
+        result = self.templateAB.action_open_quants_unreserved()
+        self.assertEqual(quant_obj.search(result['domain']), internal_quants)
+        # Everything reserved: no quant is shown anymore
+        self.pickingOutA.do_unreserve()
+        self.pickingOutA.move_lines.write({'product_uom_qty': 3})
+        self.pickingOutA.action_assign()
+        quants = quant_obj.search(result['domain'])
+        self.assertEqual(quants.mapped('product_id'), self.productA)
+        # A reserved quant is left out even if another one is free
+        free_quant = quant_obj.create(
+            {'location_id': self.bin_a.id,
+             'company_id': self.main_company.id,
+             'product_id': self.productA.id,
+             'quantity': 4.0})
+        reserved_quant = quant_obj.create(
+            {'location_id': self.bin_a.id,
+             'company_id': self.main_company.id,
+             'product_id': self.productA.id,
+             'quantity': 4.0,
+             'reserved_quantity': 4.0})
+        quants = quant_obj.search(result['domain'])
+        self.assertIn(free_quant, quants)
+        self.assertNotIn(reserved_quant, quants)
+        self.assertFalse(reserved_quant.has_unreserved_quantity)
+
+    def test_unreserved_quantities_by_location(self):
+        lot = self.env['stock.production.lot'].create({
+            'name': 'LOT A',
+            'product_id': self.productA.id,
+        })
+        quant_obj = self.env['stock.quant']
+        for location, qty, lot_id in ((self.bin_a, 10.0, False),
+                                      (self.bin_a, 4.0, lot.id),
+                                      (self.bin_b, 5.0, False)):
+            quant_obj.create({'location_id': location.id,
+                              'company_id': self.main_company.id,
+                              'product_id': self.productA.id,
+                              'lot_id': lot_id,
+                              'quantity': qty})
+        products = self.productA + self.productB
+        self.assertEqual(products._get_unreserved_quantities_by_location(), {
+            (self.productA.id, self.bin_a.id): 14.0,
+            (self.productA.id, self.bin_b.id): 5.0,
+        })
+        self.assertEqual(
+            products._get_unreserved_quantities_by_location(lot=True), {
+                (self.productA.id, self.bin_a.id, False): 10.0,
+                (self.productA.id, self.bin_a.id, lot.id): 4.0,
+                (self.productA.id, self.bin_b.id, False): 5.0,
+            })
+        self.assertEqual(
+            products.with_context(location=self.bin_b.id)
+            ._get_unreserved_quantities_by_location(package=True),
+            {(self.productA.id, self.bin_b.id, False): 5.0})
+        self.compare_qty_available_not_res(self.productA, 19)
+
+    def test_unreserved_quantities_by_lot(self):
+        lot_obj = self.env['stock.production.lot']
+        lot1 = lot_obj.create({'name': 'LOT 1',
+                               'product_id': self.productA.id})
+        lot2 = lot_obj.create({'name': 'LOT 2',
+                               'product_id': self.productA.id})
+        package = self.env['stock.quant.package'].create({'name': 'PACK'})
+        quant_obj = self.env['stock.quant']
+        for lot, package_id, qty in ((lot2, False, 3.0),
+                                     (lot1, False, 4.0),
+                                     (lot1, package.id, 2.0)):
+            quant_obj.create({'location_id': self.bin_a.id,
+                              'company_id': self.main_company.id,
+                              'product_id': self.productA.id,
+                              'lot_id': lot.id,
+                              'package_id': package_id,
+                              'quantity': qty})
+        quant_obj.create({'location_id': self.bin_b.id,
+                          'company_id': self.main_company.id,
+                          'product_id': self.productB.id,
+                          'quantity': 5.0})
+        products = self.productB + self.productA
+        res = products._get_unreserved_quantities_by_lot()
+        rows = list(zip(res['product_ids'], res['lot_ids'],
+                        res['package_ids'], res['quantities']))
+        self.assertEqual(rows, sorted([
+            (self.productA.id, lot1.id, 0, 4.0),
+            (self.productA.id, lot1.id, package.id, 2.0),
+            (self.productA.id, lot2.id, 0, 3.0),
+            (self.productB.id, 0, 0, 5.0),
+        ]))
+        self.assertEqual(res['quantities'].typecode, 'd')
+        if 'removal_date' in lot_obj._fields:
+            # The removal dates are returned whenever the lots have one
+            self.assertEqual(len(res['removal_dates']), 4)
+        else:
+            self.assertNotIn('removal_dates', res)
+        res = products._get_unreserved_quantities_by_lot(removal_order=True)
+        self.assertEqual(sorted(res['quantities']), [2.0, 3.0, 4.0, 5.0])
+
+    def test_template_search_active_variants(self):
+        self.env['stock.quant'].create(
+            {'location_id': self.stock_location.id,
+             'company_id': self.main_company.id,
+             'product_id': self.productA.id,
+             'quantity': 2.0})
+        self.check_template_found_correctly('>', 0, self.templateAB)
+        (self.productB + self.productC).write({'active': False})
+        self.check_template_found_correctly('>', 0, self.templateAB)
+        self.check_template_found_correctly('=', 0, self.env[
+            'product.template'])
+        # The stock of archived variants is left out
+        self.productA.active = False
+        self.productB.active = True
+        self.check_template_found_correctly('>', 0, self.env[
+            'product.template'])
+        self.check_template_found_correctly('=', 0, self.templateAB)